@@ -0,0 +1,474 @@
+'''
+Headless benchmarks of the HUD hot paths.
+
+Runs on the offscreen Qt platform, with Caster mocked like in test_runner.
+Results get written to a json file, which later runs can be compared against:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json
+
+Comparing exits with 1, when any result got slower (or bigger)
+than the baseline by more than the tolerance.
+'''
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from itertools import cycle
+from unittest.mock import Mock
+
+from PySide2.QtCore import QCoreApplication, QEvent
+from PySide2.QtWidgets import QApplication
+
+from benchmark_helpers import rules_json, free_port, wait_for_hud
+from test_runner import caster_modules_mock
+
+with caster_modules_mock():
+    import hud
+
+MESSAGES = [
+    '$numb one',
+    'Numbers: [<long>] numb <wnKK>, , 1',
+    '$press down',
+    'Navigation: [<mim>] press <direction> [<nnavi50>], down',
+    '@sleep',
+    'Main: [<long>] sauce [<nnavi50>] wally [<nnavi50>] lease [<nnavi50>] '
+        'ross [<nnavi50>] and a long description to wrap around',
+]
+
+LOGS = (
+    ("CommandLog", False),
+    ("VirtualCommandLog", True),
+)
+
+
+def process_events():
+    ''' Processes pending events, including deferred deletes, like the event loop '''
+    QCoreApplication.processEvents()
+    QCoreApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+
+
+def median_time(function, repeat):
+    ''' Returns the median duration of calling function, in microseconds '''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1e6
+
+
+def current_rss():
+    ''' Returns the resident set size in bytes, or None where it's unavailable '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def create_window(virtual_log = False, force_disable_background = False):
+    hud.VIRTUAL_LOG = virtual_log
+    hud.FORCE_DISABLE_BACKGROUND = force_disable_background
+    # setup methods print every setting
+    with contextlib.redirect_stdout(io.StringIO()):
+        window = hud.HUDWindow(Mock())
+    # without a frame rate limit, so sent texts get appended right away,
+    # and only the work gets timed, not the wait for the next frame
+    window.frame_interval = 0
+    window.show()
+    process_events()
+    return window
+
+
+def close_window(window):
+    window.close()
+    window.deleteLater()
+    process_events()
+
+
+def send(window, text):
+    ''' Sends a text like the send rpc, appended from the send queue once events get processed '''
+    window.xmlrpc_send(text)
+
+
+def fill_log(window, count):
+    messages = cycle(MESSAGES)
+    window.xmlrpc_send_many([next(messages) for _ in range(count)])
+    process_events()
+
+
+def bench_append(results, repeat):
+    ''' Latency of handling a sent text, with the log filled to various levels '''
+    fill_levels = {
+        "CommandLog": (0, 50, 100),
+        "VirtualCommandLog": (0, 1000, 10000),
+    }
+    for name, virtual_log in LOGS:
+        for fill in fill_levels[name]:
+            window = create_window(virtual_log)
+            fill_log(window, fill)
+            messages = cycle(MESSAGES)
+
+            def append():
+                send(window, next(messages))
+                process_events()
+
+            results["append.{}.fill_{}".format(name, fill)] = (
+                                            median_time(append, repeat), "us")
+            close_window(window)
+
+
+def bench_burst(results, repeat):
+    ''' Handling 50 texts sent at once over rpc, each by its own call '''
+    for name, virtual_log in LOGS:
+        window = create_window(virtual_log)
+        fill_log(window, 50)
+        messages = cycle(MESSAGES)
+
+        def burst():
+            for _ in range(50):
+                send(window, next(messages))
+            process_events()
+
+        results["burst_50.{}".format(name)] = (median_time(burst, repeat), "us")
+        close_window(window)
+
+
+def bench_fan_out(results, repeat):
+    ''' Appending to a HUD with followers (one window per screen), by window count '''
+    for count in (1, 3):
+        window = create_window()
+        with contextlib.redirect_stdout(io.StringIO()):
+            followers = [hud.HUDWindow(None, leader=window) for _ in range(count - 1)]
+        for follower in followers:
+            follower.show()
+        fill_log(window, 50)
+        messages = cycle(MESSAGES)
+
+        def append():
+            send(window, next(messages))
+            process_events()
+
+        results["fan_out.windows_{}".format(count)] = (median_time(append, repeat), "us")
+        for follower in followers:
+            close_window(follower)
+        close_window(window)
+
+
+def bench_resize(results, repeat):
+    ''' Relayout of a full log, when the width changes or stays the same '''
+    for name, virtual_log in LOGS:
+        window = create_window(virtual_log)
+        fill_log(window, 100)
+        widths = cycle(list(range(300, 200, -5)) + list(range(200, 300, 5)))
+
+        def resize():
+            window.resize(next(widths), window.height())
+            process_events()
+
+        results["resize.{}".format(name)] = (median_time(resize, repeat), "us")
+        results["update_text_edits.{}".format(name)] = (
+                            median_time(window.output.updateTextEdits, repeat), "us")
+        close_window(window)
+
+
+def bench_paint(results, repeat):
+    ''' Repainting a full log, and setting the mask for a disabled background '''
+    for force_disable_background in (False, True):
+        for name, virtual_log in LOGS:
+            window = create_window(virtual_log, force_disable_background)
+            fill_log(window, 100)
+
+            key = "paint.{}.force_disable_background_{}".format(
+                                            name, force_disable_background)
+            results[key] = (median_time(window.repaint, repeat), "us")
+
+            if force_disable_background:
+                def uncached():
+                    window.output.invalidateBackgroundlessMask()
+                    window.last_output_mask = None
+                    window.forceDisableBackground()
+
+                results["force_disable_background.{}.uncached".format(name)] = (
+                                            median_time(uncached, repeat), "us")
+                results["force_disable_background.{}.cached".format(name)] = (
+                            median_time(window.forceDisableBackground, repeat), "us")
+            close_window(window)
+
+
+def bench_scroll(results, repeat):
+    ''' Scrolling a full log by a few lines and repainting it, with visible backgrounds '''
+    style = (hud.RECT_COLOR, hud.RECT_OUTLINE_WIDTH, hud.BORDER_RADIUS)
+    hud.RECT_COLOR, hud.RECT_OUTLINE_WIDTH, hud.BORDER_RADIUS = (255, 255, 255, 200), 2, 8
+    for name, virtual_log in LOGS:
+        window = create_window(virtual_log)
+        fill_log(window, 100)
+        scroll_bar = window.output.verticalScrollBar()
+        positions = cycle(list(range(0, scroll_bar.maximum(), 40)) or [0])
+
+        def scroll():
+            scroll_bar.setValue(next(positions))
+            window.repaint()
+
+        results["scroll.{}".format(name)] = (median_time(scroll, repeat), "us")
+        close_window(window)
+    hud.RECT_COLOR, hud.RECT_OUTLINE_WIDTH, hud.BORDER_RADIUS = style
+
+
+def bench_rules_window(results, repeat):
+    ''' Showing and searching the rules window for a large rule set '''
+    # the rules window imports dragonfly once it's created
+    with caster_modules_mock():
+        sys.modules["dragonfly"].monitors = [Mock(rectangle = Mock(dx = 1920, dy = 1080))]
+        bench_rules_window_mocked(results, repeat)
+
+
+def bench_rules_window_mocked(results, repeat):
+    from rules_model import RulesIndex
+    text = rules_json()
+
+    def construct():
+        rules_window = hud.RulesWindow()
+        rules_window.set_rules(text)
+        rules_window.show()
+        process_events()
+        close_window(rules_window)
+
+    results["rules_window.50000_specs"] = (
+                            median_time(construct, max(repeat // 10, 3)), "us")
+
+    rules_window = hud.RulesWindow()
+    rules_window.show()
+
+    def reuse():
+        rules_window.set_rules(text)
+        process_events()
+
+    results["rules_window.reuse.50000_specs"] = (
+                            median_time(reuse, max(repeat // 10, 3)), "us")
+
+    # the call only parses the rules, the window shows and indexes them later
+    window = create_window()
+    results["show_rules_call.50000_specs"] = (
+                median_time(lambda: window.xmlrpc_show_rules(text), 3), "us")
+    deadline = time.perf_counter() + 60
+    while window.rules_window is None or window.rules_window.rules_index is None:
+        if time.perf_counter() > deadline:
+            raise RuntimeError("the shown rules weren't indexed")
+        process_events()
+        time.sleep(0.01)
+    close_window(window.rules_window)
+    close_window(window)
+
+    rules = json.loads(text)
+    results["rules_index.50000_specs"] = (
+                median_time(lambda: RulesIndex(rules), 3), "us")
+
+    # the index arrives after the rules, built on the rules indexer thread
+    def first_search():
+        shown_rules = json.loads(text)
+        rules_window.set_parsed_rules(shown_rules, index_pending=True)
+        rules_window.set_rules_index(shown_rules, RulesIndex(shown_rules))
+        process_events()
+        start = time.perf_counter()
+        rules_window.search_edit.setText("rule 3")
+        process_events()
+        duration = time.perf_counter() - start
+        rules_window.search_edit.setText("")
+        return duration
+
+    results["rules_window.first_search.50000_specs"] = (
+        statistics.median(first_search() for _ in range(3)) * 1e6, "us")
+
+    queries = cycle(["p", "ph", "phr", "phrase 1", "phrase 19 9 249", "c-12", ""])
+
+    def search():
+        rules_window.search_edit.setText(next(queries))
+        process_events()
+
+    results["rules_window.search.50000_specs"] = (median_time(search, repeat), "us")
+    close_window(rules_window)
+
+
+def bench_memory(results, repeat):
+    '''
+    Resident memory added per log entry, once added,
+    and after scrolling through the whole log, painting every entry
+    '''
+    counts = {
+        "CommandLog": 1000,
+        "VirtualCommandLog": 20000,
+    }
+    for name, virtual_log in LOGS:
+        window = create_window(virtual_log)
+        window.output.setMaxTextEdits(counts[name])
+        gc.collect()
+        before = current_rss()
+        if before is None:
+            close_window(window)
+            return
+
+        fill_log(window, counts[name])
+        gc.collect()
+        results["rss_per_entry.{}".format(name)] = (
+                        (current_rss() - before) / counts[name], "bytes")
+        close_window(window)
+
+        # distinct texts, so each entry paints differently
+        window = create_window(virtual_log)
+        window.output.setMaxTextEdits(counts[name])
+        gc.collect()
+        before = current_rss()
+        messages = cycle(MESSAGES)
+        window.xmlrpc_send_many(["{} {}".format(next(messages), number)
+                                 for number in range(counts[name])])
+        process_events()
+        scroll_bar = window.output.verticalScrollBar()
+        for position in range(0, scroll_bar.maximum() + 1, window.output.viewport().height()):
+            scroll_bar.setValue(position)
+            window.repaint()
+        gc.collect()
+        results["rss_per_entry.{}.scrolled".format(name)] = (
+                        (current_rss() - before) / counts[name], "bytes")
+        close_window(window)
+
+
+STARTUP_SCRIPT = '''
+import sys
+import time
+from test_runner import caster_modules_mock
+with caster_modules_mock():
+    start = time.perf_counter()
+    import hud
+    print(time.perf_counter() - start, flush=True)
+    hud.STARTUP_RPC = sys.argv[2] == "True"
+    # whatever the user's settings file sets
+    hud.SETTINGS_PATH = None
+    hud.run_hud(("127.0.0.1", int(sys.argv[1])))
+'''
+
+
+def start_hud(startup_rpc):
+    '''
+    Starts the HUD in a new process, returns its import time
+    and the time until it answered the first ping, in microseconds
+    '''
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+                [sys.executable, "-c", STARTUP_SCRIPT, str(port), str(startup_rpc)],
+                cwd = os.path.dirname(os.path.abspath(__file__)),
+                stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+                universal_newlines = True)
+    wait_for_hud(process, port, interval = 0.001)
+    first_ping = time.perf_counter() - start
+    try:
+        import_time = float(process.stdout.readline())
+    finally:
+        process.kill()
+        process.communicate()
+    return import_time * 1e6, first_ping * 1e6
+
+
+def bench_startup(results, repeat):
+    ''' Import time of hud, and time from starting the HUD process until it answers ping '''
+    import_times = []
+    for startup_rpc in (False, True):
+        startup_import_times, first_pings = zip(*(start_hud(startup_rpc)
+                                                  for _ in range(max(repeat // 10, 3))))
+        import_times.extend(startup_import_times)
+        results["startup.first_ping.startup_rpc_{}".format(startup_rpc)] = (
+                                        statistics.median(first_pings), "us")
+    # the same either way
+    results["startup.import"] = (statistics.median(import_times), "us")
+
+
+# memory first, before freed memory of other benchmarks gets reused
+BENCHMARKS = (
+    bench_memory,
+    bench_append,
+    bench_burst,
+    bench_fan_out,
+    bench_resize,
+    bench_paint,
+    bench_scroll,
+    bench_rules_window,
+    bench_startup,
+)
+
+
+def run(repeat):
+    results = {}
+    for benchmark in BENCHMARKS:
+        print("running " + benchmark.__name__)
+        benchmark(results, repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    ''' Prints results next to the baseline, returns names of regressions '''
+    regressions = []
+    print("{:<55} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "change"))
+    for name, (value, unit) in sorted(results.items()):
+        if name not in baseline:
+            print("{:<55} {:>12} {:>12.1f} {:>8}".format(name, "-", value, "new"))
+            continue
+        baseline_value = baseline[name][0]
+        change = value / baseline_value - 1 if baseline_value else 0
+        mark = ""
+        if change > tolerance:
+            regressions.append(name)
+            mark = "  <-- REGRESSION"
+        print("{:<55} {:>12.1f} {:>12.1f} {:>+7.0%} {}{}".format(
+                            name, baseline_value, value, change, unit, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmarks the HUD hot paths headlessly")
+    parser.add_argument("--output", default = "benchmark_results.json",
+                        help = "file to write results to")
+    parser.add_argument("--compare", metavar = "BASELINE",
+                        help = "results file to compare against, failing on regressions")
+    parser.add_argument("--tolerance", type = float, default = 0.25,
+                        help = "allowed slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument("--repeat", type = int, default = 50,
+                        help = "measurements per benchmark")
+    args = parser.parse_args()
+
+    QApplication(sys.argv)
+    results = run(args.repeat)
+
+    with open(args.output, "w") as output:
+        json.dump({
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }, output, indent = 4, sort_keys = True)
+    print("results written to " + args.output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            sys.exit(1)
+    else:
+        for name, (value, unit) in sorted(results.items()):
+            print("{:<55} {:>12.1f} {}".format(name, value, unit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''
+Helpers shared by benchmark.py and load_generator.py,
+kept apart from both, so neither has to import the other (and Qt).
+'''
+import json
+import socket
+import time
+import xmlrpc.client
+
+
+def rules_json(grammars = 20, rules = 10, specs = 250):
+    ''' Returns a show_rules payload, with grammars * rules * specs specs '''
+    return json.dumps([
+        {
+            "name": "grammar {}".format(g),
+            "rules": [
+                {
+                    "name": "rule {} {}".format(g, r),
+                    "specs": [
+                        "phrase {} {} {} [<n>]::Key(\"c-{}\")".format(g, r, s, s)
+                        for s in range(specs)
+                    ],
+                }
+                for r in range(rules)
+            ],
+        }
+        for g in range(grammars)
+    ])
+
+
+def free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        return free_socket.getsockname()[1]
+
+
+def wait_for_hud(process, port, timeout = 30, interval = 0.01):
+    ''' 
+    Returns once the HUD started as process answers ping on port.
+    Kills it and raises RuntimeError, if it exits or doesn't answer within timeout seconds.
+    '''
+    hud = xmlrpc.client.ServerProxy("http://127.0.0.1:{}".format(port))
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            hud.ping()
+            return
+        except ConnectionRefusedError:
+            if process.poll() is not None or time.perf_counter() > deadline:
+                process.kill()
+                process.communicate()
+                raise RuntimeError("the HUD didn't start")
+            time.sleep(interval)
@@ -0,0 +1,117 @@
+from PySide2.QtCore import Qt, QEvent, QRectF
+from PySide2.QtGui import (QPainter, QColor, QPalette, QPixmap,
+                           QAbstractTextDocumentLayout)
+from PySide2.QtWidgets import QWidget
+
+from command_text_edit import (CommandStyleMixin, draw_cached_background, draw_pixmap_part,
+                               cached_text_layout)
+from lru_cache import LRUCache
+
+
+# painted labels, keyed by CommandLabel.pixmapKey(), shared by all windows,
+# up to 4 MB of pixmaps (about 85 labels of 300x40, at a device pixel ratio of 1)
+label_cache = LRUCache(100, max_cost=4 * 1024 * 1024)
+
+
+class CommandLabel(CommandStyleMixin, QWidget):
+    '''
+    Static text of a command, styled like CommandTextEdit and used the same way.
+    Paints a shared layout from layout_cache, instead of keeping
+    a document, viewport, scroll bars and undo stack of its own,
+    so it takes a fraction of the memory and time to create.
+    Its text can't be selected.
+    '''
+    def __init__(self,
+                text,
+                margins,
+                rect_border_radius = 0,
+                rect_outline_color = QColor(0, 0, 0, 0),
+                rect_outline_width = 0
+        ):
+        super().__init__()
+
+        self.reset(text, margins, rect_border_radius, rect_outline_color, rect_outline_width)
+
+    def reset(self,
+                text,
+                margins,
+                rect_border_radius = 0,
+                rect_outline_color = QColor(0, 0, 0, 0),
+                rect_outline_width = 0
+        ):
+        ''' Reuses the label for a new text, with the given style '''
+        self.html = text
+        self.setRectStyle(margins, rect_border_radius, rect_outline_color, rect_outline_width)
+
+    def documentMargin(self):
+        return self.document_margin
+
+    def setDocumentMargin(self, margins):
+        self.document_margin = margins + self.rect_outline_width
+        self.text_layout = None
+
+    def textLayout(self):
+        if self.text_layout is None:
+            self.text_layout = cached_text_layout(self.html, self.font(),
+                                                  self.document_margin, self.rect_outline_width)
+        return self.text_layout
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.FontChange:
+            self.text_layout = None
+        super().changeEvent(event)
+
+    def sizeForWidth(self, width):
+        ''' Returns the preferred size for this widget, for the given width '''
+        return self.textLayout().sizeForWidth(width)
+
+    def pixmapKey(self, ratio):
+        ''' Returns what the painted label depends on '''
+        palette = self.palette()
+        base = palette.color(QPalette.Base)
+        return (self.html, self.font().key(), self.document_margin, self.width(),
+                self.height(), ratio, self.rect_border_radius, self.rect_outline_width,
+                self.rect_outline_color.rgba(), base.rgba() if base.alpha() else 0,
+                palette.color(QPalette.Text).rgba())
+
+    def paintEvent(self, event):
+        '''
+        Labels are painted into a pixmap once, shared by the same labels
+        in every window of the same style. Others get painted directly.
+        '''
+        painter = QPainter(self)
+        ratio = self.devicePixelRatioF()
+        if self.palette().brush(QPalette.Base).style() != Qt.SolidPattern:
+            self.paintLabel(painter, ratio, event.rect())
+            return
+
+        key = self.pixmapKey(ratio)
+        pixmap = label_cache.get(key)
+        if pixmap is None:
+            pixmap = QPixmap(self.size() * ratio)
+            pixmap.setDevicePixelRatio(ratio)
+            pixmap.fill(Qt.transparent)
+            pixmap_painter = QPainter(pixmap)
+            self.paintLabel(pixmap_painter, ratio, self.rect())
+            pixmap_painter.end()
+            label_cache.put(key, pixmap, pixmap.width() * pixmap.height() * pixmap.depth() // 8)
+        draw_pixmap_part(painter, self.rect(), event.rect(), pixmap)
+
+    def paintLabel(self, painter, ratio, exposed_rect):
+        if self.palette().color(QPalette.Base).alpha() > 0:
+            draw_cached_background(
+                            painter,
+                            ratio,
+                            self.rect(),
+                            exposed_rect,
+                            self.palette().brush(QPalette.Base),
+                            self.rect_border_radius,
+                            self.rect_outline_color,
+                            self.rect_outline_width
+                )
+
+        doc = self.textLayout().documentForWidth(self.width())
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette = self.palette()
+        context.clip = QRectF(exposed_rect)
+        doc.documentLayout().draw(painter, context)
@@ -1,21 +1,134 @@
-from PySide2.QtCore import Qt, QPoint
+from contextlib import contextmanager
+
+from PySide2.QtCore import Qt, QPoint, QEvent, QTimer
 from PySide2.QtGui import QPainter, QPen, QColor, QPalette, QRegion
 from PySide2.QtWidgets import QWidget, QVBoxLayout, QScrollArea 
 from PySide2.QtCore import Qt
 from PySide2 import QtWidgets
 
+from command_label import CommandLabel
 from command_text_edit import CommandTextEdit
 
 
-class CommandLog(QScrollArea):
+class CommandLogMixin:
+    '''
+    What CommandLog and VirtualCommandLog share: batched style updates, 
+    the scrolling point and the mask of the window without its background.
+    Logs provide endStyleUpdate(), mouseTrackingWidget() and commandsRegion().
+    '''
+    
+    @contextmanager
+    def styleUpdate(self):
+        '''
+        Setters called inside don't relayout commands on their own.
+        Commands get relaid out once at the end (endStyleUpdate),
+        restoring the scrollbar position from the beginning.
+        '''
+        if self.style_update_depth == 0:
+            self.style_update_position = self.getNormalizedScrollBarPosition()
+        self.style_update_depth += 1
+        try:
+            yield self
+        finally:
+            self.style_update_depth -= 1
+            if self.style_update_depth == 0:
+                relayout_pending = self.relayout_pending
+                self.relayout_pending = False
+                self.endStyleUpdate(relayout_pending, self.style_update_position)
+    
+    """
+    Scrolling point is drawn under the mouse when scrolling,
+    when the window has a fully transparent or forcefully disabled background.
+    Without it, scrolling and the mouse hitting a transparent area, 
+    stops the scrolling.
+    """
+    
+    def wheelEvent(self, event):
+        if (self.palette().color(QPalette.Window).alpha() == 0 or 
+            self.force_disable_background == True):
+            self.enableScrollingPoint(event.position())    
+        super().wheelEvent(event)
+    
+    def mouseMoveEvent(self, event):
+        self.disableScrollingPoint()
+        super().mouseMoveEvent(event)
+    
+    def leaveEvent(self, event):
+        self.disableScrollingPoint()
+        super().leaveEvent(event)
+    
+    def paintScrollingPoint(self, painter):
+        pen = QPen(QColor(0, 0, 0, 1))
+        painter.setPen(pen)
+        
+        painter.drawPoint(self.scroll_point_pos) 
+        
+    def enableScrollingPoint(self, position):
+        if self.scroll_point_pos == None:
+            self.scroll_point_pos = position
+            self.invalidateBackgroundlessMask()
+            # both required
+            self.setMouseTracking(True) 
+            self.mouseTrackingWidget().setMouseTracking(True)
+    
+    def disableScrollingPoint(self):
+        if self.scroll_point_pos:
+            self.scroll_point_pos = None
+            self.invalidateBackgroundlessMask()
+            # both required
+            self.setMouseTracking(False) 
+            self.mouseTrackingWidget().setMouseTracking(False)
+                
+            self.viewport().update()    
+    
+    def setForceDisableBackground(self, toggle):
+        self.force_disable_background = toggle
+        
+    def invalidateBackgroundlessMask(self):
+        self.backgroundless_mask = None
+    
+    def getBackgroundlessMask(self):
+        ''' 
+        Returns a mask matching the widget excluding the background.
+        The mask is kept until commands get added, removed, moved, 
+        or scrolled, or the widget gets resized.
+        '''
+        if self.backgroundless_mask is None:
+            self.backgroundless_mask = self.createBackgroundlessMask()
+        return self.backgroundless_mask
+        
+    def createBackgroundlessMask(self):
+        ''' Returns a mask of the frame and the commands inside the viewport '''
+        frame_geometry = self.frameGeometry()
+        
+        region = QRegion(frame_geometry)
+        region -= self.childrenRegion()
+        
+        region += self.commandsRegion().intersected(self.viewport().geometry())
+            
+        if self.scroll_point_pos:
+            region += QRegion(self.scroll_point_pos.x() + self.frameWidth(), 
+                              self.scroll_point_pos.y() + self.frameWidth(),
+                              1, 1)
+        return region
+
+
+class CommandLog(CommandLogMixin, QScrollArea):
     def __init__(self,
                 max_text_edits = 100,
                 text_edit_margins = 4,
                 rect_border_radius = 5,
+                max_free_text_edits = 100,
+                selectable_text = False,
         ):
         super().__init__()
         
+        # text edits are static labels, unless their text should be selectable
+        self.text_edit_class = CommandTextEdit if selectable_text else CommandLabel
         self.max_text_edits = max_text_edits
+        # cleared text edits, kept hidden to be reused by append
+        self.free_text_edits = []
+        self.max_free_text_edits = max_free_text_edits
         
         self.rect_border_radius = rect_border_radius
         self.text_edit_margins = text_edit_margins
@@ -36,8 +149,15 @@ class CommandLog(QScrollArea):
         self.scroll_point_pos = None
         self.force_disable_background = False
         self.scroll_to_bottom = False
+        self.backgroundless_mask = None
+        self.pending_scroll_position = None
+        # see styleUpdate()
+        self.style_update_depth = 0
+        self.style_update_position = None
+        self.relayout_pending = False
         
         self.verticalScrollBar().rangeChanged.connect(self.scrollToBottom)
+        self.verticalScrollBar().valueChanged.connect(self.invalidateBackgroundlessMask)
         
     def setTextEditMargins(self, margins):
         '''
@@ -45,20 +165,17 @@ class CommandLog(QScrollArea):
         '''
         if self.text_edit_margins != margins:
             self.text_edit_margins = margins
-            if self.layout.count():
-                normalized_position = self.getNormalizedScrollBarPosition()
-
-                for i in range(self.layout.count()):
-                    text_edit = self.layout.itemAt(i).widget()
-                    text_edit.setDocumentMargin(margins)
-                    self.resizeTextEdit(text_edit)
-                
-                self.setScrollBarToNormalizedPosition(normalized_position, True)
+            for i in range(self.layout.count()):
+                text_edit = self.layout.itemAt(i).widget()
+                text_edit.setDocumentMargin(margins)
+            
+            self.relayout()
                 
     def setTextEditBorderRadius(self, radius):
         ''' Retroactively sets border radius of text edits '''
         if self.rect_border_radius != radius:
             self.rect_border_radius = radius
+            self.invalidateBackgroundlessMask()
             for i in range(self.layout.count()):
                 text_edit = self.layout.itemAt(i).widget()
                 text_edit.setRectBorderRadius(radius)
@@ -95,7 +212,7 @@ class CommandLog(QScrollArea):
     def setSpacing(self, spacing):
         ''' Retroactively sets spacing between text edits '''
         if self.layout.spacing() != spacing:
-            if self.layout.count() == 0:
+            if self.layout.count() == 0 or self.style_update_depth:
                 self.layout.setSpacing(spacing)
             else:
                 normalized_position = self.getNormalizedScrollBarPosition()    
@@ -119,10 +236,12 @@ class CommandLog(QScrollArea):
         return scroll_bar.value() / scroll_bar.maximum()
         
     def setScrollBarToNormalizedPosition(self, position, wait_for_update = False):
-        # waiting for scrollbar to be updated
+        # waiting for scrollbar to be updated, 
+        # it's set on range changes, until control returns to the event loop
         if wait_for_update == True:
-            qApp.processEvents()
-            qApp.processEvents()
+            if self.pending_scroll_position is None:
+                QTimer.singleShot(0, self.applyPendingScrollPosition)
+            self.pending_scroll_position = position
             # won't be 100 accurate for middle values, 
             # but will keep scrollbar at the bottom, when at bottom
                 
@@ -144,133 +263,185 @@ class CommandLog(QScrollArea):
         ''' Retroactively sets rectangle outline width'''
         if self.rect_outline_width != width:
             self.rect_outline_width = width
-            if self.layout.count() > 0:        
-                normalized_position = self.getNormalizedScrollBarPosition()    
-                
-                for i in range(self.layout.count()):
-                    text_edit = self.layout.itemAt(i).widget()
-                    text_edit.setRectOutlineWidth(width)
-                    self.resizeTextEdit(text_edit)
-                            
-                self.setScrollBarToNormalizedPosition(normalized_position, True)
+            for i in range(self.layout.count()):
+                text_edit = self.layout.itemAt(i).widget()
+                text_edit.setRectOutlineWidth(width)
+            
+            self.relayout()
+    
+    def applyPendingScrollPosition(self):
+        if self.pending_scroll_position is not None:
+            position = self.pending_scroll_position
+            self.pending_scroll_position = None
+            self.setScrollBarToNormalizedPosition(position)
+    
+    def endStyleUpdate(self, relayout_pending, normalized_position):
+        ''' Resizes text edits once, after the setters of styleUpdate() '''
+        if relayout_pending:
+            self.updateTextEdits()
+        if self.layout.count():
+            self.setScrollBarToNormalizedPosition(normalized_position, True)
+    
+    def relayout(self):
+        ''' Resizes text edits after a style change, keeping scrollbar position '''
+        if self.style_update_depth:
+            self.relayout_pending = True
+        elif self.layout.count():
+            normalized_position = self.getNormalizedScrollBarPosition()
+            self.updateTextEdits()
+            self.setScrollBarToNormalizedPosition(normalized_position, True)
     
     def append(self, text):
         ''' Appends a new text edit to the end '''
-        command_text_edit = CommandTextEdit(
-                                    text, 
-                                    self.text_edit_margins,             
-                                    self.rect_border_radius,
-                                    self.rect_outline_color,
-                                    self.rect_outline_width
-                        )
+        self.appendMany([text])
+    
+    def appendMany(self, texts):
+        ''' 
+        Appends new text edits to the end, in one go.
+        Texts that would get cleared right away, aren't created.
+        '''
+        if len(texts) > self.max_text_edits:
+            texts = texts[len(texts) - self.max_text_edits:]
         
-        self.layout.addWidget(command_text_edit, 0, self.layout.alignment())
-        self.clearTo(self.max_text_edits)
-        command_text_edit.show()
-        self.resizeTextEdit(command_text_edit)
+        # text edits over the limit get moved to the end, with the new texts
+        reusable_text_edits = self.takeTextEdits(
+                        self.layout.count() + len(texts) - self.max_text_edits)
         
-        if self.layout.direction() == QVBoxLayout.TopToBottom:
+        command_text_edits = []
+        for text in texts:
+            command_text_edit = self.createTextEdit(text, reusable_text_edits)
+            self.layout.addWidget(command_text_edit, 0, self.layout.alignment())
+            command_text_edits.append(command_text_edit)
+        
+        for text_edit in reusable_text_edits:
+            self.freeTextEdit(text_edit)
+        
+        for command_text_edit in command_text_edits:
+            command_text_edit.show()
+            self.resizeTextEdit(command_text_edit)
+        
+        if command_text_edits and self.layout.direction() == QVBoxLayout.TopToBottom:
             self.scroll_to_bottom = True
             
-    def clearTo(self, num_to_keep):
-        if self.layout.count() > num_to_keep:
-            while self.layout.count() > num_to_keep:
+    def createTextEdit(self, text, reusable_text_edits = ()):
+        ''' 
+        Returns a text edit for the text. 
+        Reuses a just taken text edit, or a cleared one, if there is one.
+        '''
+        if reusable_text_edits or self.free_text_edits:
+            if reusable_text_edits:
+                command_text_edit = reusable_text_edits.pop()
+            else:
+                command_text_edit = self.free_text_edits.pop()
+            command_text_edit.reset(
+                                text, 
+                                self.text_edit_margins,             
+                                self.rect_border_radius,
+                                self.rect_outline_color,
+                                self.rect_outline_width
+                    )
+            return command_text_edit
+        
+        return self.text_edit_class(
+                        text, 
+                        self.text_edit_margins,             
+                        self.rect_border_radius,
+                        self.rect_outline_color,
+                        self.rect_outline_width
+            )
+    
+    def takeTextEdits(self, count):
+        ''' 
+        Removes the oldest text edits from the layout, returning them hidden.
+        (moving a shown text edit to the end costs more than showing it again)
+        '''
+        text_edits = []
+        if count > 0:
+            while self.layout.count() and len(text_edits) < count:
                 child = self.layout.takeAt(0)
                 if child.widget():
-                    child.widget().deleteLater()
+                    child.widget().hide()
+                    text_edits.append(child.widget())
             self.update()
+        return text_edits
+        
+    def clearTo(self, num_to_keep):
+        for text_edit in self.takeTextEdits(self.layout.count() - num_to_keep):
+            self.freeTextEdit(text_edit)
+    
+    def freeTextEdit(self, text_edit):
+        ''' Keeps a cleared text edit for reuse, while there is room for it '''
+        if len(self.free_text_edits) < self.max_free_text_edits:
+            self.free_text_edits.append(text_edit)
+        else:
+            text_edit.deleteLater()
     
     def clear(self):
         self.clearTo(0)
     
     def scrollToBottom(self):
+        if self.pending_scroll_position is not None:
+            self.setScrollBarToNormalizedPosition(self.pending_scroll_position)
         if self.scroll_to_bottom == True:
             self.scroll_to_bottom = False
             self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
         
     def resizeEvent(self, event):
         super().resizeEvent(event)
+        self.invalidateBackgroundlessMask()
         self.updateTextEdits()
         
     def updateTextEdits(self):
+        if self.style_update_depth:
+            self.relayout_pending = True
+            return
         for i in range(self.layout.count()):
             self.resizeTextEdit(self.layout.itemAt(i).widget())
         
+    def layoutStyle(self):
+        ''' Returns what layouts of new text edits depend on: font, margin, outline and width '''
+        return (self.font(), self.text_edit_margins + self.rect_outline_width,
+                self.rect_outline_width, self.viewport().width())
+        
     def resizeTextEdit(self, text):
         size = text.sizeForWidth(self.viewport().width())
         text.setFixedSize(size)
     
-    """
-    Scrolling point is drawn under the mouse when scrolling,
-    when the window has a fully transparent or forcefully disabled background.
-    Without it, scrolling and the mouse hitting a transparent area, 
-    stops the scrolling.
-    """
-    
-    def wheelEvent(self, event):
-        if (self.palette().color(QPalette.Window).alpha() == 0 or 
-            self.force_disable_background == True):
-            self.enableScrollingPoint(event.position())    
-        super().wheelEvent(event)
-    
-    def mouseMoveEvent(self, event):
-        self.disableScrollingPoint()
-        super().mouseMoveEvent(event)
-    
-    def leaveEvent(self, event):
-        self.disableScrollingPoint()
-        super().leaveEvent(event)
-    
     def paintEvent(self, event):
         super().paintEvent(event)
         if self.scroll_point_pos:
-            painter = QPainter(self.viewport())
-            
-            pen = QPen(QColor(0, 0, 0, 1))
-            painter.setPen(pen)
-        
-            painter.drawPoint(self.scroll_point_pos) 
-        
-    def enableScrollingPoint(self, position):
-        if self.scroll_point_pos == None:
-            self.scroll_point_pos = position
-            # both required
-            self.setMouseTracking(True) 
-            self.widget().setMouseTracking(True)
+            self.paintScrollingPoint(QPainter(self.viewport()))
     
-    def disableScrollingPoint(self):
-        if self.scroll_point_pos:
-            self.scroll_point_pos = None
-            # both required
-            self.setMouseTracking(False) 
-            self.widget().setMouseTracking(False)
-                
-            self.update()    
-    
-    def setForceDisableBackground(self, toggle):
-        self.force_disable_background = toggle
+    def mouseTrackingWidget(self):
+        return self.widget()
         
-    def getBackgroundlessMask(self):
-        ''' Returns a mask matching the widget excluding the background '''
-        frame_geometry = self.frameGeometry()
+    def viewportContentsRegion(self):
+        ''' Returns the region, in viewport coordinates, that text edits are in '''
+        return self.viewport().childrenRegion()
         
-        region = QRegion(frame_geometry)
-        region -= self.childrenRegion()
+    def eventFilter(self, watched, event):
+        ''' 
+        The scroll area already filters events of its widget.
+        Text edits only move, when the widget gets laid out or resized.
+        '''
+        if (watched is self.widget() and 
+            event.type() in (QEvent.LayoutRequest, QEvent.Resize)):
+            self.invalidateBackgroundlessMask()
+        return super().eventFilter(watched, event)
         
+    def commandsRegion(self):
+        ''' Returns the region of the text edits inside the viewport '''
+        viewport_rect = self.viewport().rect()
+        log_offset = self.widget().pos()
+        text_edits_region = QRegion()
         for i in range(self.layout.count()):
             text_edit = self.layout.itemAt(i).widget()
-            text_edit_region = text_edit.region()
+            if not viewport_rect.intersects(text_edit.geometry().translated(log_offset)):
+                continue
             
             text_edit_top_left = text_edit.rect().topLeft() 
             text_edit_top_left += QPoint(self.frameWidth(), self.frameWidth())
             
             offset = text_edit.mapTo(self.viewport(), text_edit_top_left)
-            text_edit_region.translate(offset)
-            region += text_edit_region
-            
-        if self.scroll_point_pos:
-            region += QRegion(self.scroll_point_pos.x() + self.frameWidth(), 
-                              self.scroll_point_pos.y() + self.frameWidth(),
-                              1, 1)
-        return region
-    
\ No newline at end of file
+            text_edits_region += text_edit.region().translated(offset)
+        return text_edits_region
@@ -1,11 +1,255 @@
-from PySide2.QtCore import Qt, QSize
-from PySide2.QtGui import QPainter, QPen, QColor, QPalette
+from PySide2.QtCore import Qt, QSize, QRect, QRectF
+from PySide2.QtGui import QPainter, QPen, QColor, QPalette, QRegion, QPixmap
 from PySide2.QtWidgets import QTextEdit, QFrame
 
 from PySide2 import QtGui
 import math
 
-class CommandTextEdit(QTextEdit):
+from lru_cache import LRUCache
+
+
+def draw_rect_background(
+                painter,
+                rect,
+                brush,
+                border_radius,
+                outline_color,
+                outline_width
+    ):
+    ''' Draws the (rounded) rectangle with its outline, used behind commands '''
+    painter.setRenderHint(QPainter.Antialiasing, True)
+    painter.setBrush(brush)
+    
+    pen = QPen(outline_color)
+    if border_radius == 0:
+        pen.setWidthF(outline_width * 2)
+        painter.setPen(pen)
+        painter.drawRect(rect)
+    else:
+        pen.setWidthF(outline_width)
+        painter.setPen(pen)
+        
+        if border_radius > rect.height() / 2:
+            border_radius = rect.height() /2
+            
+        half_outline_width = outline_width / 2
+        rect = rect.adjusted(
+                            half_outline_width, half_outline_width, 
+                            -half_outline_width, -half_outline_width
+                        )
+        painter.drawRoundedRect(rect, border_radius, border_radius)
+        if outline_width > 1:
+            inner_radius = border_radius + half_outline_width
+            painter.drawRoundedRect(rect, inner_radius, inner_radius)
+
+
+# pixmaps of backgrounds keyed by their size and style, shared by all command logs and windows
+background_cache = LRUCache(100)
+# width of the stretched middle of 3-slice pixmaps
+SLICE_MIDDLE = 4
+
+
+def background_pixmap(width, height, ratio, brush, border_radius, outline_color, outline_width):
+    ''' Returns a pixmap of the background of a rect of the given size, drawn once '''
+    key = (width, height, ratio, border_radius, 
+           brush.color().rgba(), outline_color.rgba(), outline_width)
+    pixmap = background_cache.get(key)
+    if pixmap is None:
+        pixmap = QPixmap(QSize(width, height) * ratio)
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(Qt.transparent)
+        pixmap_painter = QPainter(pixmap)
+        draw_rect_background(pixmap_painter, QRect(0, 0, width, height), 
+                             brush, border_radius, outline_color, outline_width)
+        pixmap_painter.end()
+        background_cache.put(key, pixmap)
+    return pixmap
+
+
+def draw_cached_background(
+                painter,
+                ratio,
+                rect,
+                exposed_rect,
+                brush,
+                border_radius,
+                outline_color,
+                outline_width
+    ):
+    '''
+    Draws like draw_rect_background, but only the part inside exposed_rect,
+    on a device with the given pixel ratio (painter.device() of a pixmap
+    would leak a copy of it), from a 3-slice pixmap drawn once per height and style:
+    its left and right ends are drawn as they are, its middle stretched to the width.
+    At fractional device pixel ratios slices wouldn't line up with pixels,
+    so like rects too narrow to slice, they get a pixmap per size.
+    '''
+    exposed_rect = exposed_rect.intersected(rect)
+    if exposed_rect.isEmpty():
+        return
+    if brush.style() != Qt.SolidPattern:
+        painter.save()
+        painter.setClipRect(exposed_rect)
+        draw_rect_background(painter, rect, brush, border_radius, outline_color, outline_width)
+        painter.restore()
+        return
+    
+    height = rect.height()
+    # the radius gets clamped to half the height, like draw_rect_background does
+    border_radius = min(border_radius, height / 2)
+    end = math.ceil(border_radius + outline_width) + 1
+    width = 2 * end + SLICE_MIDDLE
+    if ratio != int(ratio) or rect.width() < width:
+        pixmap = background_pixmap(rect.width(), height, ratio, brush, 
+                                   border_radius, outline_color, outline_width)
+        draw_pixmap_part(painter, rect, exposed_rect, pixmap)
+        return
+    
+    pixmap = background_pixmap(width, height, ratio, brush, 
+                               border_radius, outline_color, outline_width)
+    left = rect.left()
+    right = rect.right() + 1
+    top = exposed_rect.top() - rect.top()
+    exposed_height = exposed_rect.height()
+    # source and target columns: left end, stretched middle, right end
+    for source_x, source_width, x, target_width in (
+                (0, end, left, end),
+                (end, SLICE_MIDDLE, left + end, right - left - 2 * end),
+                (width - end, end, right - end, end)):
+        part_left = max(x, exposed_rect.left())
+        part_right = min(x + target_width, exposed_rect.right() + 1)
+        if part_left >= part_right:
+            continue
+        scale = source_width / target_width
+        source = QRectF((source_x + (part_left - x) * scale) * ratio, top * ratio,
+                        (part_right - part_left) * scale * ratio, exposed_height * ratio)
+        painter.drawPixmap(QRectF(part_left, exposed_rect.top(), part_right - part_left,
+                                  exposed_height), pixmap, source)
+
+
+def draw_pixmap_part(painter, rect, exposed_rect, pixmap):
+    ''' Draws the part of a pixmap covering rect, that's inside exposed_rect '''
+    ratio = pixmap.devicePixelRatio()
+    # the source rect is in pixels of the pixmap
+    source = QRectF(exposed_rect.translated(-rect.topLeft()))
+    source = QRectF(source.topLeft() * ratio, source.size() * ratio)
+    painter.drawPixmap(QRectF(exposed_rect), pixmap, source)
+
+
+def rect_region(rect, border_radius):
+    ''' Returns the area covered by a rectangle with rounded corners '''
+    path = QtGui.QPainterPath()
+    path.addRoundedRect(rect, border_radius, border_radius)
+    
+    return path.toFillPolygon().toPolygon()
+
+
+class TextLayout:
+    '''
+    A laid out document of a text, with its ideal size.
+    Shared through layout_cache, by everything showing the same html
+    in the same style, so a repeated text doesn't get laid out again.
+    At widths above the ideal width, the size doesn't change,
+    so that's all it gets computed for.
+    '''
+    __slots__ = ('document', 'ideal_width', 'ideal_size', 'width', 'size')
+    
+    def __init__(self, document):
+        self.document = document
+        document.setTextWidth(99999)
+        self.ideal_width = document.idealWidth()
+        document.setTextWidth(self.ideal_width)
+        self.ideal_size = QSize(math.ceil(document.idealWidth()), 
+                                math.ceil(document.size().height()))
+        self.width = None
+        self.size = None
+    
+    def documentForWidth(self, width):
+        # left aligned text is laid out the same, at any width above the ideal one
+        width = min(width, self.ideal_width)
+        if self.document.textWidth() != width:
+            self.document.setTextWidth(width)
+        return self.document
+    
+    def sizeForWidth(self, width):
+        if width >= self.ideal_width:
+            return self.ideal_size
+        if self.width != width:
+            doc = self.documentForWidth(width)
+            self.width = width
+            self.size = QSize(math.ceil(doc.idealWidth()), math.ceil(doc.size().height()))
+        return self.size
+
+
+# keyed by layout_key(), shared by all command logs and windows
+layout_cache = LRUCache(500)
+
+
+def layout_key(html, font, document_margin, rect_outline_width):
+    ''' Returns the layout_cache key, of what a layout depends on besides width '''
+    return (html, font.key(), document_margin, rect_outline_width)
+
+
+def create_text_layout(html, font, document_margin):
+    ''' Lays out html in a document of its own, a clone would be deleted with its text edit '''
+    doc = QtGui.QTextDocument()
+    doc.setUndoRedoEnabled(False)
+    doc.setDefaultFont(font)
+    doc.setDocumentMargin(document_margin)
+    # like in a QTextEdit, words wider than the log wrap instead of overflowing it
+    option = doc.defaultTextOption()
+    option.setWrapMode(QtGui.QTextOption.WrapAtWordBoundaryOrAnywhere)
+    doc.setDefaultTextOption(option)
+    doc.setHtml(html)
+    return TextLayout(doc)
+
+
+def cached_text_layout(html, font, document_margin, rect_outline_width):
+    ''' Returns the layout of html in the given style, laying it out on a miss '''
+    key = layout_key(html, font, document_margin, rect_outline_width)
+    text_layout = layout_cache.get(key)
+    if text_layout is None:
+        text_layout = create_text_layout(html, font, document_margin)
+        layout_cache.put(key, text_layout)
+    return text_layout
+
+
+class CommandStyleMixin:
+    '''
+    Style of a command's rectangle, shared by CommandTextEdit and CommandLabel:
+    border radius, outline, margins, and the region the rectangle covers.
+    The document margin includes the outline width, classes keep it
+    in their own way, through documentMargin() and setDocumentMargin(margins).
+    '''
+    region_cache_key = None
+    
+    def setRectStyle(self, margins, rect_border_radius, rect_outline_color, rect_outline_width):
+        self.setRectOutlineColor(rect_outline_color)
+        self.rect_outline_width = rect_outline_width
+        self.setRectBorderRadius(rect_border_radius)
+        self.setDocumentMargin(margins)
+    
+    def setRectBorderRadius(self, rect_border_radius):
+        self.rect_border_radius = rect_border_radius
+    
+    def setRectOutlineColor(self, color):
+        self.rect_outline_color = color
+    
+    def setRectOutlineWidth(self, new_width):
+        base_document_margin = self.documentMargin() - self.rect_outline_width
+        self.rect_outline_width = new_width
+        self.setDocumentMargin(base_document_margin)
+    
+    def region(self):
+        ''' Returns the region of the rectangle, cached for its size and radius '''
+        key = (self.size(), self.rect_border_radius)
+        if self.region_cache_key != key:
+            self.region_cache_key = key
+            self.cached_region = QRegion(rect_region(self.rect(), self.rect_border_radius))
+        return self.cached_region
+
+
+class CommandTextEdit(CommandStyleMixin, QTextEdit):
     def __init__(self,
                 text,
                 margins,
@@ -15,10 +259,11 @@ class CommandTextEdit(QTextEdit):
         ):
         super().__init__(text)
         
-        self.setRectOutlineColor(rect_outline_color)
-        self.rect_outline_width = rect_outline_width
-        self.setRectBorderRadius(rect_border_radius)
-        self.setDocumentMargin(margins)
+        self.html = text
+        self.text_layout = None
+        self.layout_cache_key = None
+        self.document().contentsChanged.connect(self.invalidateLayoutCache)
+        self.setRectStyle(margins, rect_border_radius, rect_outline_color, rect_outline_width)
         
         self.setReadOnly(True)
         self.setFrameShape(QFrame.NoFrame)
@@ -26,74 +271,65 @@ class CommandTextEdit(QTextEdit):
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.viewport().setAutoFillBackground(False)
         
-    def setRectBorderRadius(self, rect_border_radius):
-        self.rect_border_radius = rect_border_radius
+    def reset(self,
+                text,
+                margins,
+                rect_border_radius = 0,
+                rect_outline_color = QColor(0, 0, 0, 0),
+                rect_outline_width = 0
+        ):
+        ''' Reuses the text edit for a new text, with the given style '''
+        if text != self.html:
+            self.setHtml(text)
+            self.html = text
+        
+        self.setRectStyle(margins, rect_border_radius, rect_outline_color, rect_outline_width)
+        
+    def documentMargin(self):
+        return self.document().documentMargin()
         
     def setDocumentMargin(self, margins):
         self.document().setDocumentMargin(margins + self.rect_outline_width)
     
-    def setRectOutlineColor(self, color):
-        self.rect_outline_color = color
+    def layoutCacheKey(self):
+        ''' Returns what the layout of the document depends on, besides width '''
+        doc = self.document()
+        return layout_key(self.html, doc.defaultFont(), doc.documentMargin(), 
+                          self.rect_outline_width)
     
-    def setRectOutlineWidth(self, new_width):
-        base_document_margin = self.document().documentMargin() - self.rect_outline_width
-        self.rect_outline_width = new_width
-        self.setDocumentMargin(base_document_margin)
+    def invalidateLayoutCache(self):
+        self.layout_cache_key = None
     
     def sizeForWidth(self, width):
-        ''' Returns the preferred size for this widget, for the given width '''
-        doc = self.document().clone()
-        
-        doc.setTextWidth(99999)
-        max_width = doc.idealWidth()
-        if width > max_width:
-            width = max_width
-        doc.setTextWidth(width);
-        
-        height = doc.size().height()
-        width = math.ceil(doc.idealWidth())
+        ''' 
+        Returns the preferred size for this widget, for the given width.
+        The layout is kept until the text, font, margins or outline width change,
+        and shared with other text edits of the same text and style.
+        '''
+        key = self.layoutCacheKey()
+        if self.layout_cache_key != key:
+            self.layout_cache_key = key
+            doc = self.document()
+            self.text_layout = cached_text_layout(self.html, doc.defaultFont(), 
+                                                  doc.documentMargin(), self.rect_outline_width)
         
-        return QSize(width, height)
+        return self.text_layout.sizeForWidth(width)
         
     def paintEvent(self, event):
         if self.palette().color(QPalette.Base).alpha() > 0:
             painter = QPainter(self.viewport())
-            painter.setRenderHint(QPainter.Antialiasing, True)
-            
-            brush = self.palette().brush(QPalette.Base)
-            painter.setBrush(brush)
-            
-            border_radius = self.rect_border_radius
-            
-            pen = QPen(self.rect_outline_color)
-            if border_radius == 0:
-                pen.setWidthF(self.rect_outline_width * 2)
-                painter.setPen(pen)
-                painter.drawRect(self.rect())
-            else:
-                pen.setWidthF(self.rect_outline_width)
-                painter.setPen(pen)
-                
-                if border_radius > self.height() / 2:
-                    border_radius = self.height() /2
-                    
-                half_outline_width = self.rect_outline_width / 2
-                rect = self.rect().adjusted(
-                                    half_outline_width, half_outline_width, 
-                                    -half_outline_width, -half_outline_width
-                                )
-                painter.drawRoundedRect(rect, border_radius, border_radius)
-                if self.rect_outline_width > 1:
-                    inner_radius = border_radius + half_outline_width
-                    painter.drawRoundedRect(rect, inner_radius, inner_radius)
+            draw_cached_background(
+                            painter, 
+                            self.viewport().devicePixelRatioF(),
+                            self.rect(), 
+                            event.rect(),
+                            self.palette().brush(QPalette.Base),
+                            self.rect_border_radius,
+                            self.rect_outline_color,
+                            self.rect_outline_width
+                )
         
         super().paintEvent(event)
-    
-    def region(self):
-        path = QtGui.QPainterPath()
-        path.addRoundedRect(self.rect(), self.rect_border_radius, self.rect_border_radius)
-        
-        return path.toFillPolygon().toPolygon()
         
     def mouseMoveEvent(self, event):
         ''' 
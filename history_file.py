@@ -0,0 +1,143 @@
+import mmap
+import os
+import queue
+import struct
+import threading
+
+
+class HistoryFile:
+    '''
+    Persistent command history, in a memory mapped file of a fixed size.
+    The file is a ring buffer, the oldest records are overwritten by new ones.
+
+    Records are utf-8 texts with their length before and after,
+    so the newest ones can be read backwards from the head.
+    Records are either between tail and head, or once wrapped
+    between tail and wrap_end followed by the ones from the start up to head.
+    A record which doesn't fit before the end of the file, starts at the
+    beginning instead, wrap_end marks where the records before it end.
+
+    Appended texts are written in batches by a writer thread,
+    so appending doesn't wait for the file.
+    '''
+    MAGIC = b'HUDH'
+    VERSION = 1
+    # magic, version, data size, head, tail, wrap end, count
+    HEADER = struct.Struct('<4sIIIIII')
+    LENGTH = struct.Struct('<I')
+
+    def __init__(self, path, size=4 * 1024 * 1024):
+        self.data_size = size - HistoryFile.HEADER.size
+        # longer texts get cut, so a single record never fills the file
+        self.max_record_size = self.data_size // 4
+        self.lock = threading.Lock()
+        self.open(path, size)
+
+        self.queue = queue.SimpleQueue()
+        self.writer_thread = threading.Thread(target=self.write_queued)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def open(self, path, size):
+        ''' Maps the file, starting a new one if it's missing or doesn't match '''
+        exists = os.path.exists(path) and os.path.getsize(path) == size
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+        magic, version, data_size, *state = HistoryFile.HEADER.unpack_from(self.map)
+        if (magic, version, data_size) == (HistoryFile.MAGIC, HistoryFile.VERSION,
+                                           self.data_size):
+            self.head, self.tail, self.wrap_end, self.count = state
+        else:
+            self.head = self.tail = self.wrap_end = self.count = 0
+            self.write_header()
+
+    def write_header(self):
+        HistoryFile.HEADER.pack_into(self.map, 0, HistoryFile.MAGIC,
+                                     HistoryFile.VERSION, self.data_size,
+                                     self.head, self.tail, self.wrap_end, self.count)
+
+    def append(self, text):
+        ''' Queues text to be written by the writer thread '''
+        self.queue.put(text)
+
+    def close(self):
+        ''' Writes the queued texts and closes the file '''
+        self.queue.put(None)
+        self.writer_thread.join()
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+
+    def write_queued(self):
+        while True:
+            texts = [self.queue.get()]
+            # everything queued meanwhile is written as one batch
+            try:
+                while True:
+                    texts.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            closing = None in texts
+            if closing:
+                texts = texts[:texts.index(None)]
+            with self.lock:
+                for text in texts:
+                    self.write(text)
+                self.write_header()
+            if closing:
+                return
+
+    def write(self, text):
+        data = text.encode('utf-8')[:self.max_record_size - 2 * HistoryFile.LENGTH.size]
+        length = HistoryFile.LENGTH.pack(len(data))
+        record_size = len(data) + 2 * len(length)
+
+        if self.count == 0:
+            self.head = self.tail = self.wrap_end = 0
+        if self.head + record_size > self.data_size:
+            # records after the head are dropped, it wraps to the start
+            while self.count and self.tail >= self.head:
+                self.drop_oldest()
+            self.wrap_end = self.head
+            self.head = 0
+        # records the new one would overwrite
+        while self.count and self.head <= self.tail < self.head + record_size:
+            self.drop_oldest()
+
+        position = HistoryFile.HEADER.size + self.head
+        self.map[position:position + record_size] = length + data + length
+        self.head += record_size
+        self.count += 1
+
+    def drop_oldest(self):
+        position = HistoryFile.HEADER.size + self.tail
+        length, = HistoryFile.LENGTH.unpack_from(self.map, position)
+        self.tail += length + 2 * HistoryFile.LENGTH.size
+        self.count -= 1
+        if self.tail >= self.wrap_end:
+            self.tail = 0
+
+    def last(self, count):
+        ''' Returns the newest count texts, oldest first '''
+        texts = []
+        with self.lock:
+            position = self.head
+            for _ in range(min(count, self.count)):
+                if position == 0:
+                    position = self.wrap_end
+                end = HistoryFile.HEADER.size + position
+                length, = HistoryFile.LENGTH.unpack_from(self.map, end - HistoryFile.LENGTH.size)
+                start = end - length - 2 * HistoryFile.LENGTH.size
+                # a record cut short by a crash, older ones can't be found
+                if (start < HistoryFile.HEADER.size or
+                        HistoryFile.LENGTH.unpack_from(self.map, start)[0] != length):
+                    break
+                texts.append(self.map[start + HistoryFile.LENGTH.size:
+                                      end - HistoryFile.LENGTH.size].decode('utf-8', 'replace'))
+                position = start - HistoryFile.HEADER.size
+        texts.reverse()
+        return texts
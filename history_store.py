@@ -0,0 +1,59 @@
+import re
+import threading
+import time
+
+from collections import deque
+
+
+class HistoryRecord:
+    ''' A sent text, without its kind marker ($ command, @ status, '' anything else) '''
+    __slots__ = ('timestamp', 'kind', 'text')
+
+    def __init__(self, timestamp, kind, text):
+        self.timestamp = timestamp
+        self.kind = kind
+        self.text = text
+
+
+class HistoryStore:
+    '''
+    The most recent sent texts, kept apart from the widgets showing them,
+    so they can be queried from the server thread without touching Qt.
+    '''
+    KINDS = ('$', '@')
+
+    def __init__(self, max_records=10000):
+        self.records = deque(maxlen=max_records)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, text):
+        ''' Records a sent text, at the current time '''
+        kind = text[:1]
+        if kind in HistoryStore.KINDS:
+            text = text[1:]
+        else:
+            kind = ''
+        record = HistoryRecord(time.time(), kind, text)
+        with self.lock:
+            self.records.append(record)
+
+    def query(self, pattern='', since=0, limit=100):
+        '''
+        Returns the newest records (up to limit), oldest first,
+        whose text matches the regular expression pattern,
+        recorded at or after since (seconds since the epoch).
+        '''
+        search = re.compile(pattern).search
+        with self.lock:
+            records = list(self.records)
+        matches = []
+        for record in reversed(records):
+            if record.timestamp < since or len(matches) >= limit:
+                break
+            if search(record.text):
+                matches.append(record)
+        matches.reverse()
+        return matches
@@ -4,19 +4,19 @@ Caster HUD Window module
 '''
 # pylint: disable=import-error,no-name-in-module
 import html
-import json
+import math
 import os
 import signal
+import socketserver
 import sys
 import threading
+import time
 import PySide2.QtCore
 import PySide2.QtGui
-import dragonfly
-from xmlrpc.server import SimpleXMLRPCServer
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 from PySide2.QtWidgets import QApplication
 from PySide2.QtWidgets import QMainWindow
 from PySide2.QtWidgets import QTextEdit
-from PySide2.QtWidgets import QTreeView
 from PySide2.QtWidgets import QVBoxLayout
 from PySide2.QtWidgets import QWidget
 try:  # Style C -- may be imported into Caster, or externally
@@ -28,7 +28,16 @@ finally:
     from castervoice.lib.merge.communication import Communicator
     from castervoice.lib import settings
 
+import hud_profiler
+import hud_stats
+from command_label import CommandLabel, label_cache
 from command_log import CommandLog
+from command_text_edit import CommandTextEdit, layout_cache, background_cache
+from history_file import HistoryFile
+from history_store import HistoryStore
+from layout_pool import LayoutPool
+from lru_cache import LRUCache
+from virtual_command_log import VirtualCommandLog
 
 from PySide2.QtCore import Qt, QSize
 from PySide2.QtGui import QPalette, QColor, QFont, QRegion
@@ -42,6 +51,7 @@ WINDOW_OFFSET_X = 20
 WINDOW_OFFSET_Y = 50
 WINDOW_ALIGNMENT = Qt.AlignRight | Qt.AlignBottom
 SCREEN = 0
+EXTRA_SCREENS = ()
 # command log
 DIRECTION = QVBoxLayout.TopToBottom
 ALIGNMENT = Qt.AlignRight | Qt.AlignBottom
@@ -53,20 +63,73 @@ RECT_OUTLINE_WIDTH = 0
 RECT_MARGINS = 4
 SPACING = 5
 FORCE_DISABLE_BACKGROUND = False
+FRAME_RATE = 60
+LAYOUT_WORKERS = 0
+GROUP_UTTERANCES = False
+UTTERANCE_WAIT = 200
+SELECTABLE_TEXT = False
+VIRTUAL_LOG = False
+VIRTUAL_LOG_MAX_ENTRIES = 50000
 # palette
 BACKGROUND_COLOR = (0, 0, 0, 50)
 TEXT_COLOR = None
 FONT_SIZE = None
 FONT_FAMILY = ""
 RECT_COLOR = None
+# history
+HISTORY_MAX_ENTRIES = 10000
+PERSISTENT_HISTORY = False
+PERSISTENT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".caster_hud_history")
+PERSISTENT_HISTORY_SIZE = 4 * 1024 * 1024
+PERSISTENT_HISTORY_RESTORE = 100
+# server
+RPC_SERVER_THREADED = False
+STARTUP_RPC = False
+COLLECT_STATS = False
+# profiling
+PROFILING = bool(os.environ.get("CASTER_HUD_PROFILING"))
+PROFILE_PATH = os.path.join(os.path.expanduser("~"), ".caster_hud_profiles")
+MEMORY_SNAPSHOT_INTERVAL = 0
+# settings file
+SETTINGS_PATH = os.path.join(os.path.expanduser("~"), ".caster_hud_settings.py")
+WATCH_SETTINGS = True
+SETTINGS_RELOAD_DELAY = 100
+
+# every setting above
+SETTING_NAMES = tuple(name for name in dict(globals()) if name.isupper() and name != "BASE_PATH")
+# settings the settings file can change while the HUD runs, the others apply after a restart
+GEOMETRY_SETTINGS = {"WIDTH", "HEIGHT", "WINDOW_OFFSET_X", "WINDOW_OFFSET_Y", "WINDOW_ALIGNMENT"}
+COMMAND_LOG_SETTINGS = {"DIRECTION", "ALIGNMENT", "SCROLL_BAR_OFF", "DRAW_FRAME", "BORDER_RADIUS",
+                        "RECT_OUTLINE_COLOR", "RECT_OUTLINE_WIDTH", "RECT_MARGINS", "SPACING",
+                        "FORCE_DISABLE_BACKGROUND"}
+PALETTE_SETTINGS = {"BACKGROUND_COLOR", "TEXT_COLOR", "FONT_SIZE", "FONT_FAMILY", "RECT_COLOR"}
+RELOADABLE_SETTINGS = (GEOMETRY_SETTINGS | COMMAND_LOG_SETTINGS | PALETTE_SETTINGS |
+                       {"WINDOW_FRAMELESS", "FRAME_RATE", "GROUP_UTTERANCES", "UTTERANCE_WAIT"})
                         
 
-CLEAR_HUD_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
 HIDE_HUD_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
 SHOW_HUD_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
 HIDE_RULES_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
 SHOW_RULES_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
-SEND_COMMAND_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
+SHOW_PARSED_RULES_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
+RULES_INDEXED_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
+RESTORE_HISTORY_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
+DRAIN_SEND_QUEUE_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
+PROFILE_START_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
+PROFILE_STOP_EVENT = PySide2.QtCore.QEvent.Type(PySide2.QtCore.QEvent.registerEventType(-1))
+
+EVENT_NAMES = {
+    HIDE_HUD_EVENT: "hide_hud",
+    SHOW_HUD_EVENT: "show_hud",
+    HIDE_RULES_EVENT: "hide_rules",
+    SHOW_RULES_EVENT: "show_rules",
+    SHOW_PARSED_RULES_EVENT: "show_rules_delta",
+    RULES_INDEXED_EVENT: "rules_indexed",
+    RESTORE_HISTORY_EVENT: "restore_history",
+    DRAIN_SEND_QUEUE_EVENT: "drain_send_queue",
+    PROFILE_START_EVENT: "profile_start",
+    PROFILE_STOP_EVENT: "profile_stop",
+}
 
 
 class RPCEvent(PySide2.QtCore.QEvent):
@@ -74,18 +137,356 @@ class RPCEvent(PySide2.QtCore.QEvent):
     def __init__(self, type, text):
         PySide2.QtCore.QEvent.__init__(self, type)
         self._text = text
+        # for the queue delay, until the GUI thread handles the event
+        self.posted_at = time.perf_counter() if hud_stats.enabled else None
 
     @property
     def text(self):
         return self._text
 
 
+class KeepAliveXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+    '''
+    Keeps the connection open between requests (HTTP/1.1 keep-alive),
+    so clients reusing their ServerProxy don't reconnect for every call.
+    '''
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't wait for acks in between
+    disable_nagle_algorithm = True
+
+
+class ThreadingXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    '''
+    Handles each connection on its own thread, so calls don't queue
+    behind each other. Handlers only post events to the GUI thread,
+    calls on the same connection still arrive in order.
+    '''
+    daemon_threads = True
+
+
+def format_text(text):
+    ''' Returns the html of a sent text, marked by its kind ($ command, @ status) '''
+    escaped_text = html.escape(text)
+    if escaped_text.startswith('$'):
+        return '<font color="blue">&lt;</font><b>{}</b>'.format(escaped_text[1:])
+    elif escaped_text.startswith('@'):
+        return '<font color="purple">&gt;</font><b>{}</b>'.format(escaped_text[1:])
+    elif escaped_text.startswith(''):
+        return '<font color="red">&gt;</font>{}'.format(escaped_text)
+    else:
+        return escaped_text
+
+
+# html of recently sent texts, repeated commands are formatted once
+format_cache = LRUCache(1000)
+
+
+def enable_stats():
+    ''' Wraps the hot paths with timing, reported by the stats rpc '''
+    if hud_stats.enabled:
+        return
+    hud_stats.enable()
+    hud_stats.instrument_event(HUDWindow, EVENT_NAMES)
+    hud_stats.instrument(HUDWindow, "forceDisableBackground", "drain_send_queue")
+    hud_stats.instrument(CommandLog, "append", "appendMany", "resizeTextEdit")
+    hud_stats.instrument(VirtualCommandLog, "append", "appendMany", "paintEvent")
+    hud_stats.instrument(CommandTextEdit, "paintEvent")
+    hud_stats.instrument(CommandLabel, "paintEvent")
+    hud_stats.register_cache("format_cache", format_cache)
+    hud_stats.register_cache("layout_cache", layout_cache)
+    hud_stats.register_cache("background_cache", background_cache)
+    hud_stats.register_cache("label_cache", label_cache)
+
+
+def create_xmlrpc_server(server_address):
+    # allow_none=True means Python constant None will be translated into XML
+    if RPC_SERVER_THREADED:
+        return ThreadingXMLRPCServer(server_address, 
+                                     requestHandler=KeepAliveXMLRPCRequestHandler,
+                                     logRequests=False, allow_none=True)
+    return SimpleXMLRPCServer(server_address, logRequests=False, allow_none=True)
+
+
+class SendQueue:
+    '''
+    Texts sent from the server thread(s), for the window to append in batches.
+    Only the first text after the window took the queue posts an event,
+    everything sent until it gets handled is appended at once.
+    None marks a clear_hud call, so it stays in order with the texts.
+    '''
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.texts = []
+        # times of the puts since the last take, for the queue delay (only with stats)
+        self.put_times = []
+        self.drain_posted = False
+        self.layout_pool = None
+
+    def put(self, texts):
+        with self.lock:
+            self.texts.extend(texts)
+            if hud_stats.enabled:
+                self.put_times.append(time.perf_counter())
+        if self.layout_pool:
+            # wakes the window, once the texts are laid out
+            self.layout_pool.submit(texts)
+        else:
+            self.wake()
+
+    def wake(self):
+        ''' Posts an event for the window to take the queue, unless one is pending '''
+        with self.lock:
+            if self.drain_posted:
+                return
+            self.drain_posted = True
+        # not an RPCEvent, the queue delay is recorded once the texts are appended
+        PySide2.QtCore.QCoreApplication.postEvent(self.window, PySide2.QtCore.QEvent(DRAIN_SEND_QUEUE_EVENT))
+
+    def take(self):
+        ''' Returns the queued texts and the times they were put, the next put posts an event again '''
+        with self.lock:
+            texts = self.texts
+            put_times = self.put_times
+            self.texts = []
+            self.put_times = []
+            self.drain_posted = False
+        return texts, put_times
+
+
+def any_changed(names, *settings):
+    ''' Returns whether any of settings is in names, all of them are when names is None '''
+    return names is None or not names.isdisjoint(settings)
+
+
+def same_setting(value, other):
+    ''' Returns whether two values of a setting are equal, Qt flags by their value '''
+    if value == other:
+        return True
+    # Qt.Alignment and other flags don't compare equal to ones with the same value
+    return (type(value) is type(other) and not isinstance(value, (int, float)) and
+            hasattr(value, "__int__") and int(value) == int(other))
+
+
+class SettingsFile:
+    '''
+    Settings from a python file, assigning any of the settings above
+    (with Qt and QVBoxLayout available), like WIDTH = 400.
+    A setting it stops assigning gets back the value it had before the file was loaded.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.base = {name: globals()[name] for name in SETTING_NAMES}
+
+    def read(self):
+        ''' Returns every setting, by name, or None if the file can't be run (while being edited) '''
+        namespace = {"Qt": Qt, "QVBoxLayout": QVBoxLayout}
+        try:
+            with open(self.path) as settings_file:
+                exec(compile(settings_file.read(), self.path, "exec"), namespace)
+        except Exception as e:
+            print("settings file not loaded: " + str(e))
+            return None
+        values = dict(self.base)
+        for name, value in namespace.items():
+            if name in values:
+                values[name] = value
+        return values
+
+    def changes(self):
+        ''' Returns the settings whose value in the file differs from the current one '''
+        values = self.read() or {}
+        return {name: value for name, value in values.items()
+                if not same_setting(globals()[name], value)}
+
+    def load(self):
+        ''' Assigns the settings of the file, before the windows are built '''
+        print("setting settings file: " + str(self.path))
+        globals().update(self.changes())
+
+
+class StartupRPC:
+    '''
+    Serves the HUD's xmlrpc server while the window is still being built.
+    Answers ping right away, so Caster doesn't wait for the window,
+    and keeps sent texts and clear_hud calls (as None) in order, 
+    the last shown rules (parsed), and a kill, until the window takes over (attach).
+    Showing and hiding the window, which isn't shown yet, does nothing.
+    The history is empty and nothing is profiled meanwhile.
+    '''
+
+    def __init__(self, server):
+        self.lock = threading.Lock()
+        self.texts = []
+        # event type and parsed rules, of the last show_rules or show_rules_delta
+        self.rules = None
+        # grammars of show_rules_delta, handed to the window
+        self.rules_cache = None
+        self.killed = False
+        self.window = None
+        server.register_function(self.ping, "ping")
+        server.register_function(self.kill, "kill")
+        server.register_function(self.send, "send")
+        server.register_function(self.send_many, "send_many")
+        server.register_function(self.clear_hud, "clear_hud")
+        server.register_function(self.show_rules, "show_rules")
+        server.register_function(self.show_rules_delta, "show_rules_delta")
+        server.register_function(self.hide_rules, "hide_rules")
+        server.register_function(self.show_hud, "show_hud")
+        server.register_function(self.hide_hud, "hide_hud")
+        server.register_function(self.stats, "stats")
+        server.register_function(self.query_history, "query_history")
+        server.register_function(self.profile_start, "profile_start")
+        server.register_function(self.profile_stop, "profile_stop")
+        server.register_function(self.memory_snapshot, "memory_snapshot")
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def attach(self, window):
+        ''' Queues the kept texts for the window, later calls are passed to it '''
+        with self.lock:
+            if self.texts:
+                window.send_queue.put(self.texts)
+            if self.rules is not None:
+                window.show_parsed_rules(*self.rules)
+            if self.rules_cache is not None:
+                window.rules_cache = self.rules_cache
+            if self.killed:
+                # once the event loop runs
+                PySide2.QtCore.QTimer.singleShot(0, QApplication.quit)
+            self.texts = []
+            self.rules = None
+            self.rules_cache = None
+            self.window = window
+
+    def ping(self):
+        return 0
+
+    def kill(self):
+        with self.lock:
+            if self.window is None:
+                self.killed = True
+                return None
+        return self.window.xmlrpc_kill()
+
+    def send(self, text):
+        with self.lock:
+            if self.window is None:
+                self.texts.append(text)
+                return len(text)
+        return self.window.xmlrpc_send(text)
+
+    def send_many(self, texts):
+        with self.lock:
+            if self.window is None:
+                self.texts.extend(texts)
+                return len(texts)
+        return self.window.xmlrpc_send_many(texts)
+
+    def clear_hud(self):
+        with self.lock:
+            if self.window is None:
+                self.texts.append(None)
+                return 0
+        return self.window.xmlrpc_clear()
+
+    def show_rules(self, text):
+        with self.lock:
+            window = self.window
+        if window:
+            return window.xmlrpc_show_rules(text)
+        import json
+        rules = json.loads(text)
+        with self.lock:
+            if self.window is None:
+                self.rules = (SHOW_RULES_EVENT, rules)
+                return len(text)
+        return self.window.xmlrpc_show_rules(text)
+
+    def show_rules_delta(self, grammars):
+        from rules_model import RulesCache
+        with self.lock:
+            window = self.window
+            if window is None:
+                if self.rules_cache is None:
+                    self.rules_cache = RulesCache()
+                rules_cache = self.rules_cache
+        if window:
+            return window.xmlrpc_show_rules_delta(grammars)
+        rules, missing = rules_cache.resolve(grammars)
+        with self.lock:
+            if self.window is None:
+                if not missing:
+                    self.rules = (SHOW_PARSED_RULES_EVENT, rules)
+                return missing
+        return self.window.xmlrpc_show_rules_delta(grammars)
+
+    def hide_rules(self):
+        with self.lock:
+            if self.window is None:
+                self.rules = None
+                return 0
+        return self.window.xmlrpc_hide_rules()
+
+    def show_hud(self):
+        with self.lock:
+            if self.window is None:
+                return 0
+        return self.window.xmlrpc_show_hud()
+
+    def hide_hud(self):
+        with self.lock:
+            if self.window is None:
+                return 0
+        return self.window.xmlrpc_hide_hud()
+
+    def stats(self, reset=False):
+        return hud_stats.snapshot(reset)
+
+    def query_history(self, pattern="", since=0, limit=100):
+        with self.lock:
+            if self.window is None:
+                return []
+        return self.window.xmlrpc_query_history(pattern, since, limit)
+
+    def profile_start(self):
+        with self.lock:
+            if self.window is None:
+                return 0
+        return self.window.xmlrpc_profile_start()
+
+    def profile_stop(self):
+        with self.lock:
+            if self.window is None:
+                return []
+        return self.window.xmlrpc_profile_stop()
+
+    def memory_snapshot(self, limit=10):
+        with self.lock:
+            if self.window is None:
+                return {"path": "", "top": []}
+        return self.window.xmlrpc_memory_snapshot(limit)
+
+
 class RulesWindow(QWidget):
 
     _WIDTH = 600
     _MARGIN = 30
+    # search results with up to this many rules get expanded
+    _EXPAND_LIMIT = 20
+    # expanding stops before showing more rows than this
+    _EXPAND_ROWS = 200
 
-    def __init__(self, text):
+    def __init__(self):
+        # only needed by the rules window, imported once it's first shown
+        import dragonfly
+        from PySide2.QtWidgets import QLineEdit
+        from PySide2.QtWidgets import QTreeView
+        from rules_model import RulesModel
+        
         QWidget.__init__(self, f=(PySide2.QtCore.Qt.WindowStaysOnTopHint))
         x = dragonfly.monitors[0].rectangle.dx - (RulesWindow._WIDTH + RulesWindow._MARGIN)
         y = 300
@@ -93,62 +494,249 @@ class RulesWindow(QWidget):
         dy = dragonfly.monitors[0].rectangle.dy - (y + 2 * RulesWindow._MARGIN)
         self.setGeometry(x, y, dx, dy)
         self.setWindowTitle("Active Rules")
-        rules_tree = PySide2.QtGui.QStandardItemModel()
-        rules_tree.setColumnCount(2)
-        rules_tree.setHorizontalHeaderLabels(['phrase', 'action'])
-        rules_dict = json.loads(text)
-        rules = rules_tree.invisibleRootItem()
-        for g in rules_dict:
-            gram = PySide2.QtGui.QStandardItem(g["name"]) if len(g["rules"]) > 1 else None
-            for r in g["rules"]:
-                rule = PySide2.QtGui.QStandardItem(r["name"])
-                rule.setRowCount(len(r["specs"]))
-                rule.setColumnCount(2)
-                row = 0
-                for s in r["specs"]:
-                    phrase, _, action = s.partition('::')
-                    rule.setChild(row, 0, PySide2.QtGui.QStandardItem(phrase))
-                    rule.setChild(row, 1, PySide2.QtGui.QStandardItem(action))
-                    row += 1
-                if gram is None:
-                    rules.appendRow(rule)
-                else:
-                    gram.appendRow(rule)
-            if gram:
-                rules.appendRow(gram)
-        tree_view = QTreeView(self)
-        tree_view.setModel(rules_tree)
-        tree_view.setColumnWidth(0, RulesWindow._WIDTH / 2)
+        self.rules = []
+        self.rules_index = None
+        self.index_pending = False
+        self.search_edit = QLineEdit(self)
+        self.search_edit.setPlaceholderText("search phrases, actions, rules and grammars")
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.textChanged.connect(self.filter_rules)
+        self.rules_model = RulesModel(self)
+        self.tree_view = QTreeView(self)
+        self.tree_view.setModel(self.rules_model)
+        self.tree_view.setColumnWidth(0, RulesWindow._WIDTH / 2)
         layout = QVBoxLayout()
-        layout.addWidget(tree_view)
+        layout.addWidget(self.search_edit)
+        layout.addWidget(self.tree_view)
         self.setLayout(layout)
 
+    def set_rules(self, text):
+        ''' 
+        Shows the rules of a show_rules json payload. 
+        Rows of a rule or grammar are only created once it's expanded.
+        '''
+        import json
+        self.set_parsed_rules(json.loads(text))
+
+    def set_parsed_rules(self, rules, index_pending=False):
+        ''' 
+        Shows parsed rules. With index_pending, their rules_model.RulesIndex
+        is being built on another thread, searches wait for set_rules_index.
+        Otherwise it's built on the first search of these rules.
+        Grammars which are the same objects as before, 
+        like cached ones of show_rules_delta, keep their rows and index.
+        '''
+        from rules_model import same_grammars
+        if same_grammars(rules, self.rules):
+            return
+        self.rules = rules
+        self.rules_index = None
+        self.index_pending = index_pending
+        self.filter_rules(self.search_edit.text())
+
+    def set_rules_index(self, rules, rules_index):
+        ''' Sets the index of the shown rules, searching the query typed while it was built '''
+        from rules_model import same_grammars
+        if self.rules_index is not None or not same_grammars(rules, self.rules):
+            return
+        self.rules_index = rules_index
+        self.index_pending = False
+        if self.search_edit.text():
+            self.filter_rules(self.search_edit.text())
+
+    def filter_rules(self, query):
+        ''' Shows only the rules matching the query, all of them while it's empty '''
+        if not query:
+            self.rules_model.updateRules(self.rules)
+            return
+        if self.index_pending:
+            # searched once the index arrives
+            return
+        if self.rules_index is None:
+            from rules_model import RulesIndex
+            self.rules_index = RulesIndex(self.rules)
+        filtered_rules = self.rules_index.search(query)
+        self.rules_model.setRules(filtered_rules)
+        
+        rules_count = sum(len(grammar["rules"]) for grammar in filtered_rules)
+        if rules_count <= RulesWindow._EXPAND_LIMIT:
+            self.expand_all_fetched()
+
+    def expand_all_fetched(self):
+        ''' 
+        Expands grammars and then rules, fetching their rows,
+        skipping those which would show more than _EXPAND_ROWS rows in all.
+        '''
+        model = self.rules_model
+        rows_count = model.rowCount()
+        parents = [PySide2.QtCore.QModelIndex()]
+        # a level at a time, so grammars get expanded before any of their rules
+        while parents:
+            children = []
+            for parent in parents:
+                for row in range(model.rowCount(parent)):
+                    index = model.index(row, 0, parent)
+                    if not model.hasChildren(index):
+                        continue
+                    children_count = len(model.nodeAt(index).items)
+                    if rows_count + children_count > RulesWindow._EXPAND_ROWS:
+                        continue
+                    rows_count += children_count
+                    if model.canFetchMore(index):
+                        model.fetchMore(index)
+                    self.tree_view.expand(index)
+                    children.append(index)
+            parents = children
+
 
 class HUDWindow(QMainWindow):
 
-    def __init__(self, server):
+    def __init__(self, server, startup_rpc=None, screen=SCREEN, leader=None, settings_file=None):
+        '''
+        A window with a leader shows the texts sent to the leader, on its own screen.
+        It shares the leader's history and has neither a server nor a history file.
+        A window with a settings file watches it, applying changes to every window.
+        '''
         QMainWindow.__init__(self)
+        if COLLECT_STATS:
+            print("setting collect stats: On")
+            enable_stats()
         self.server = server
-        self.setup_xmlrpc_server()
-        self.output = CommandLog()
+        self.startup_rpc = startup_rpc
+        self.screen_index = screen
+        self.followers = []
+        # created by the first show_rules_delta
+        self.rules_cache = None
+        self.rules_cache_lock = threading.Lock()
+        # created by the first shown rules
+        self.rules_indexer = None
+        self.send_queue = SendQueue(self)
+        self.frame_interval = 1 / FRAME_RATE if FRAME_RATE else 0
+        self.last_drain_time = 0
+        self.drain_timer_pending = False
+        if leader:
+            leader.followers.append(self)
+            self.history = leader.history
+            self.history_file = None
+        else:
+            self.history = HistoryStore(HISTORY_MAX_ENTRIES)
+            # before the server, so the history is restored ahead of sent commands
+            self.setup_history()
+            self.setup_xmlrpc_server()
+        if VIRTUAL_LOG:
+            print("setting virtual log: On, max entries: " + str(VIRTUAL_LOG_MAX_ENTRIES))
+            self.output = VirtualCommandLog(VIRTUAL_LOG_MAX_ENTRIES)
+        else:
+            print("setting selectable text: " + str(SELECTABLE_TEXT))
+            self.output = CommandLog(selectable_text=SELECTABLE_TEXT)
         self.setCentralWidget(self.output)
         
         self.rules_window = None
         self.commands_count = 0
+        # formatted lines of the last command, while waiting for its descriptions
+        self.pending_utterance = None
+        # the log gets cleared with the next append, not to stay empty meanwhile
+        self.log_clear_pending = False
+        self.utterance_timer = PySide2.QtCore.QTimer(self)
+        self.utterance_timer.setSingleShot(True)
+        self.utterance_timer.timeout.connect(self.flush_utterance)
+        if GROUP_UTTERANCES:
+            print("setting group utterances, wait: " + str(UTTERANCE_WAIT))
         self.drag_begin_pos = None
+        self.last_output_mask = None
+        self.last_mask_geometries = None
         
         self.setup_window()
-        self.setup_command_log()
-        self.setup_palette()
+        # a single relayout, for all of the command log settings
+        with self.output.styleUpdate():
+            self.setup_command_log()
+            self.setup_palette()
+        if LAYOUT_WORKERS and not leader:
+            self.setup_layout_pool()
+        self.settings_file = settings_file
+        if settings_file and WATCH_SETTINGS:
+            self.setup_settings_watcher()
+    
+    def setup_layout_pool(self):
+        print("setting layout workers: " + str(LAYOUT_WORKERS))
+        layout_pool = LayoutPool(LAYOUT_WORKERS, format_text, self.send_queue.wake, 
+                                 QApplication.instance().thread())
+        layout_pool.set_style(*self.output.layoutStyle())
+        self.send_queue.layout_pool = layout_pool
         
+    def setup_settings_watcher(self):
+        print("setting watch settings: On")
+        self.settings_watcher = PySide2.QtCore.QFileSystemWatcher([self.settings_file.path], self)
+        # editors save in several steps, the file is read once they're done
+        self.settings_timer = PySide2.QtCore.QTimer(self)
+        self.settings_timer.setSingleShot(True)
+        self.settings_timer.timeout.connect(self.reload_settings)
+        self.settings_watcher.fileChanged.connect(lambda: self.settings_timer.start(SETTINGS_RELOAD_DELAY))
+
+    def reload_settings(self):
+        ''' Applies the settings the settings file changed, to every window '''
+        # editors saving by replacing the file, drop it from the watcher
+        if self.settings_file.path not in self.settings_watcher.files():
+            self.settings_watcher.addPath(self.settings_file.path)
+        changes = self.settings_file.changes()
+        for name in sorted(changes.keys() - RELOADABLE_SETTINGS):
+            print("setting " + name + " applies after a restart")
+            del changes[name]
+        if not changes:
+            return
+        start = time.perf_counter()
+        globals().update(changes)
+        for window in self.windows():
+            window.apply_settings(set(changes))
+        print("settings reloaded in {:.1f} ms: {}".format(
+                        (time.perf_counter() - start) * 1000, ", ".join(sorted(changes))))
+
+    def apply_settings(self, names):
+        ''' Applies only the changed settings (names), with a single relayout of the command log '''
+        if "FRAME_RATE" in names:
+            self.frame_interval = 1 / FRAME_RATE if FRAME_RATE else 0
+        if "WINDOW_FRAMELESS" in names:
+            print("setting frameless window: " + str(WINDOW_FRAMELESS))
+            visible = self.isVisible()
+            self.setWindowFlag(Qt.FramelessWindowHint, bool(WINDOW_FRAMELESS))
+            # changing window flags hides the window
+            if visible:
+                self.show()
+        if not names.isdisjoint(GEOMETRY_SETTINGS):
+            self.setup_geometry()
+        if not names.isdisjoint(COMMAND_LOG_SETTINGS | PALETTE_SETTINGS):
+            with self.output.styleUpdate():
+                self.setup_command_log(names)
+                self.setup_palette(names)
+        if "FORCE_DISABLE_BACKGROUND" in names and not FORCE_DISABLE_BACKGROUND:
+            self.clearMask()
+            self.last_output_mask = None
+        self.update()
+
+    def setup_history(self):
+        self.history_file = None
+        if not PERSISTENT_HISTORY:
+            return
+        print("setting persistent history: " + str(PERSISTENT_HISTORY_PATH))
+        self.history_file = HistoryFile(PERSISTENT_HISTORY_PATH, PERSISTENT_HISTORY_SIZE)
+        # restored once the event loop runs, not to delay showing the window
+        PySide2.QtCore.QCoreApplication.postEvent(self, PySide2.QtCore.QEvent(RESTORE_HISTORY_EVENT))
+
+    def restore_history(self):
+        ''' Appends the newest commands of the history file, all at once '''
+        texts = self.history_file.last(PERSISTENT_HISTORY_RESTORE)
+        if texts:
+            for window in self.windows():
+                window.output.appendMany(texts)
+                # the first command after a restart doesn't clear the restored ones
+                window.commands_count = max(window.commands_count, 1)
+
+    def windows(self):
+        ''' Returns this window and the ones following it '''
+        return [self] + self.followers
+
     def setup_window(self):
         window_frameless = WINDOW_FRAMELESS
-        width = WIDTH
-        height = HEIGHT
-        window_offset_x = WINDOW_OFFSET_X
-        window_offset_y = WINDOW_OFFSET_Y
-        window_alignment = WINDOW_ALIGNMENT
-        screen = SCREEN
         
         self.setWindowTitle(settings.HUD_TITLE)
         self.setWindowFlags(Qt.WindowStaysOnTopHint)
@@ -157,6 +745,15 @@ class HUDWindow(QMainWindow):
         if window_frameless:
             print("setting frameless window: On")
             self.setWindowFlag(Qt.FramelessWindowHint, True)
+        self.setup_geometry()
+
+    def setup_geometry(self):
+        width = WIDTH
+        height = HEIGHT
+        window_offset_x = WINDOW_OFFSET_X
+        window_offset_y = WINDOW_OFFSET_Y
+        window_alignment = WINDOW_ALIGNMENT
+        screen = self.screen_index
         
         if type(width) is not int:
             print("setting default width: 300")
@@ -205,7 +802,8 @@ class HUDWindow(QMainWindow):
             )
         )
 
-    def setup_command_log(self):
+    def setup_command_log(self, names=None):
+        ''' Applies the command log settings, or with names only those '''
         direction = DIRECTION
         alignment = ALIGNMENT
         scroll_bar_off = SCROLL_BAR_OFF
@@ -217,40 +815,48 @@ class HUDWindow(QMainWindow):
         spacing = SPACING
         force_disable_background = FORCE_DISABLE_BACKGROUND
         
-        if direction:
+        if direction and any_changed(names, "DIRECTION"):
             print("setting direction: " + str(direction))
             self.output.setDirection(direction)
-        if alignment:
+        if alignment and any_changed(names, "ALIGNMENT"):
             print("setting alignment: " + str(alignment))
             self.output.setAlignment(alignment) 
-        if scroll_bar_off:
-            print("setting scroll bar: off")
-            self.output.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff) 
-        else:
-            print("setting scroll bar: on")
-            self.output.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        if any_changed(names, "SCROLL_BAR_OFF"):
+            if scroll_bar_off:
+                print("setting scroll bar: off")
+                self.output.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff) 
+            else:
+                print("setting scroll bar: on")
+                self.output.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
         
-        if type(border_radius) in (float, int):            
+        if type(border_radius) in (float, int) and any_changed(names, "BORDER_RADIUS"):
             print("setting border radius: " + str(border_radius))
             self.output.setTextEditBorderRadius(border_radius) 
-        if rect_outline_color and rect_outline_width > 0:
+        if (rect_outline_color and rect_outline_width > 0 and
+                any_changed(names, "RECT_OUTLINE_COLOR", "RECT_OUTLINE_WIDTH")):
             print("setting color outline color: " + str(rect_outline_color))
             self.output.setRectOutlineColor(QColor(*rect_outline_color))
-        if type(rect_outline_width) in (float, int):            
+        if type(rect_outline_width) in (float, int) and any_changed(names, "RECT_OUTLINE_WIDTH"):
             print("setting rect outline width: " + str(rect_outline_width))
             self.output.setRectOutlineWidth(rect_outline_width)
-        if type(rect_margins) in (float, int):
+        if type(rect_margins) in (float, int) and any_changed(names, "RECT_MARGINS"):
             print("setting rect_margins: " + str(rect_margins))
             self.output.setTextEditMargins(rect_margins)
-        if type(spacing) in (float, int):
+        if type(spacing) in (float, int) and any_changed(names, "SPACING"):
             print("setting spacing: " + str(spacing))
             self.output.setSpacing(spacing)
-        print("setting draw frame: " + str(draw_frame))                
-        self.output.setDrawFrame(draw_frame)
-        print("setting force background off: " + str(force_disable_background))                
-        self.output.setForceDisableBackground(force_disable_background)
+        if any_changed(names, "DRAW_FRAME"):
+            print("setting draw frame: " + str(draw_frame))                
+            self.output.setDrawFrame(draw_frame)
+        if any_changed(names, "FORCE_DISABLE_BACKGROUND"):
+            print("setting force background off: " + str(force_disable_background))                
+            self.output.setForceDisableBackground(force_disable_background)
     
-    def setup_palette(self):
+    def setup_palette(self, names=None):
+        ''' 
+        Applies the palette and font settings, or with names only those.
+        Text edits get laid out again only when the font changed.
+        '''
         background_color = BACKGROUND_COLOR
         text_color = TEXT_COLOR
         font_size = FONT_SIZE
@@ -260,72 +866,179 @@ class HUDWindow(QMainWindow):
         palette = self.palette()
         font = self.font()
         
-        if background_color:
-            print("setting background color: " + str(background_color))
-            palette.setColor(QPalette.Window, QColor(*background_color))
-        
-        # setting background alpha 0, so it doesn't show through transparent rectangle
-        if self.output.force_disable_background:
-            default_color = palette.color(QPalette.Window)    
-            default_color.setAlpha(0)
-            palette.setColor(QPalette.Window, default_color)
+        if any_changed(names, "BACKGROUND_COLOR", "FORCE_DISABLE_BACKGROUND"):
+            if background_color:
+                print("setting background color: " + str(background_color))
+                palette.setColor(QPalette.Window, QColor(*background_color))
+            
+            # setting background alpha 0, so it doesn't show through transparent rectangle
+            if self.output.force_disable_background:
+                default_color = palette.color(QPalette.Window)    
+                default_color.setAlpha(0)
+                palette.setColor(QPalette.Window, default_color)
         
-        if text_color:
+        if text_color and any_changed(names, "TEXT_COLOR"):
             print("setting text color: " + str(text_color))
             palette.setColor(QPalette.Text, QColor(*text_color))
-        if font_size:
+        if font_size and any_changed(names, "FONT_SIZE"):
             print("setting font size: " + str(font_size))
             font.setPointSize(font_size)
-        if font_family:
+        if font_family and any_changed(names, "FONT_FAMILY"):
             print("setting font family: " + str(font_family))
             font.setFamily(font_family)
-        if rect_color:
+        if rect_color and any_changed(names, "RECT_COLOR"):
             print("setting rect color: " + str(rect_color))
             palette.setColor(QPalette.Base, QColor(*rect_color))
         
-        self.setFont(font)
-        self.setPalette(palette)
-        self.output.updateTextEdits()
+        if names is None or palette != self.palette():
+            self.setPalette(palette)
+        if font != self.font() or names is None:
+            self.setFont(font)
+            self.output.updateTextEdits()
         
     
     def event(self, event):
         if event.type() == SHOW_HUD_EVENT:
-            self.show()
+            for window in self.windows():
+                window.show()
             return True
         if event.type() == HIDE_HUD_EVENT:
-            self.hide()
+            for window in self.windows():
+                window.hide()
             return True
-        if event.type() == SHOW_RULES_EVENT:
-            self.rules_window = RulesWindow(event.text)
+        if event.type() in (SHOW_RULES_EVENT, SHOW_PARSED_RULES_EVENT):
+            # the window is reused, only its rules get replaced
+            if self.rules_window is None:
+                self.rules_window = RulesWindow()
+            self.rules_window.set_parsed_rules(event.text, index_pending=True)
             self.rules_window.show()
             return True
+        if event.type() == RULES_INDEXED_EVENT:
+            self.rules_window.set_rules_index(*event.text)
+            return True
         if event.type() == HIDE_RULES_EVENT and self.rules_window:
-            self.rules_window.close()
-            self.rules_window = None
+            self.rules_window.hide()
             return True
-        if event.type() == SEND_COMMAND_EVENT:
-            escaped_text = html.escape(event.text)
-            if escaped_text.startswith('$'):
-                formatted_text = '<font color="blue">&lt;</font><b>{}</b>'.format(escaped_text[1:])
-                if self.commands_count == 0:
-                    self.output.clear()
-                self.output.append(formatted_text)
-                
-                self.commands_count += 1
-                return True
-            if escaped_text.startswith('@'):
-                formatted_text = '<font color="purple">&gt;</font><b>{}</b>'.format(escaped_text[1:])
-            elif escaped_text.startswith(''):
-                formatted_text = '<font color="red">&gt;</font>{}'.format(escaped_text)
-            else:
-                formatted_text = escaped_text
-            self.output.append(formatted_text)
+        if event.type() == DRAIN_SEND_QUEUE_EVENT:
+            self.schedule_drain()
+            return True
+        if event.type() == RESTORE_HISTORY_EVENT:
+            self.restore_history()
+            return True
+        if event.type() == PROFILE_START_EVENT:
+            hud_profiler.start()
             return True
-        if event.type() == CLEAR_HUD_EVENT:
-            self.commands_count = 0
+        if event.type() == PROFILE_STOP_EVENT:
+            hud_profiler.stop(event.text)
             return True
         return QMainWindow.event(self, event)
 
+    def schedule_drain(self):
+        '''
+        Drains the send queue right away, unless it was drained within
+        the last frame (FRAME_RATE), then at the start of the next one.
+        '''
+        if self.drain_timer_pending:
+            return
+        wait = self.last_drain_time + self.frame_interval - time.perf_counter()
+        if wait > 0:
+            self.drain_timer_pending = True
+            PySide2.QtCore.QTimer.singleShot(math.ceil(wait * 1000), self.drain_send_queue)
+        else:
+            self.drain_send_queue()
+
+    def drain_send_queue(self):
+        self.drain_timer_pending = False
+        self.last_drain_time = time.perf_counter()
+        layout_pool = self.send_queue.layout_pool
+        if layout_pool:
+            # layouts made before a style or width change get discarded
+            layout_pool.set_style(*self.output.layoutStyle())
+            layout_pool.take()
+        texts, put_times = self.send_queue.take()
+        self.append_commands(texts)
+        if put_times:
+            # from the call, including the wait for the frame and the layout pool
+            appended_at = time.perf_counter()
+            for put_at in put_times:
+                hud_stats.record("queue_delay", appended_at - put_at)
+
+    def append_commands(self, texts):
+        ''' 
+        Formats sent texts and records them in the history, once,
+        then shows them in this window and the ones following it.
+        None (a queued clear_hud) makes the next command clear the logs.
+        '''
+        formatted_texts = []
+        history_file = self.history_file
+        for text in texts:
+            if text is None:
+                formatted_texts.append(None)
+                continue
+            self.history.append(text)
+            formatted_text = format_cache.get(text)
+            if formatted_text is None:
+                formatted_text = format_text(text)
+                format_cache.put(text, formatted_text)
+            if history_file:
+                history_file.append(formatted_text)
+            formatted_texts.append(formatted_text)
+        for window in self.windows():
+            window.show_commands(texts, formatted_texts)
+
+    def show_commands(self, texts, formatted_texts):
+        '''
+        Appends the formatted sent texts to the command log at once,
+        so a batch costs a single layout, mask and scroll update.
+        
+        With GROUP_UTTERANCES, a command is held for UTTERANCE_WAIT ms,
+        and the description lines sent meanwhile become part of its entry.
+        '''
+        entries = []
+        utterance = self.pending_utterance
+        for text, formatted_text in zip(texts, formatted_texts):
+            if text is None:
+                self.commands_count = 0
+                continue
+            if text.startswith('$'):
+                if self.commands_count == 0:
+                    self.log_clear_pending = True
+                    entries = []
+                    utterance = None
+                self.commands_count += 1
+                if GROUP_UTTERANCES:
+                    if utterance:
+                        entries.append('<br>'.join(utterance))
+                    utterance = [formatted_text]
+                    self.utterance_timer.start(UTTERANCE_WAIT)
+                    continue
+            elif utterance:
+                if not text.startswith('@'):
+                    utterance.append(formatted_text)
+                    continue
+                # status lines get entries of their own, after the command
+                entries.append('<br>'.join(utterance))
+                utterance = None
+            entries.append(formatted_text)
+        self.pending_utterance = utterance
+        if self.log_clear_pending and (entries or not utterance):
+            self.log_clear_pending = False
+            self.output.clear()
+        
+        if len(entries) == 1:
+            self.output.append(entries[0])
+        elif entries:
+            self.output.appendMany(entries)
+
+    def flush_utterance(self):
+        ''' Appends the held command, with the descriptions sent so far '''
+        if self.pending_utterance:
+            if self.log_clear_pending:
+                self.log_clear_pending = False
+                self.output.clear()
+            self.output.append('<br>'.join(self.pending_utterance))
+            self.pending_utterance = None
+
     def mousePressEvent(self, event):
         is_frameless = self.windowFlags() & Qt.FramelessWindowHint
         has_background = (self.output.force_disable_background == False and
@@ -351,7 +1064,16 @@ class HUDWindow(QMainWindow):
         ''' 
         Sets a mask of what to draw. 
         Including everything, except the background.
+        Skipped, while neither the command log's mask nor the geometry changed.
         '''
+        output_mask = self.output.getBackgroundlessMask()
+        geometries = (self.frameGeometry(), self.geometry())
+        if (output_mask is self.last_output_mask and 
+                geometries == self.last_mask_geometries):
+            return
+        self.last_output_mask = output_mask
+        self.last_mask_geometries = geometries
+        
         frame_geometry = self.frameGeometry()
         
         offset_x = self.x() - self.geometry().x()
@@ -359,17 +1081,18 @@ class HUDWindow(QMainWindow):
         frame_geometry.moveTo(offset_x, offset_y)
         
         region = QRegion(frame_geometry)
-        # output.viewport().childrenRegion() extends above, including titlebar
+        # output.viewportContentsRegion() extends above, including titlebar
         # childrenRegion() includes scrollbar
         # Their intersection doesn't include neither a scrollbar nor a titlebar
-        region -= self.output.viewport().childrenRegion().intersected(
+        region -= self.output.viewportContentsRegion().intersected(
                         self.childrenRegion())
         # alt solution to ^
         # viewport_region = self.output.viewport().childrenRegion().boundingRect()
         # region -= QRegion(0, 0, viewport_region.width(), viewport_region.height() + viewport_region.y())
         
-        region += self.output.getBackgroundlessMask()
-        self.setMask(region)
+        region += output_mask
+        if region != self.mask():
+            self.setMask(region)
         
     def paintEvent(self, event):
         if self.output.force_disable_background == True:
@@ -380,21 +1103,35 @@ class HUDWindow(QMainWindow):
         event.accept()
 
     def setup_xmlrpc_server(self):
+        if self.startup_rpc:
+            # before registering send, so the kept texts come first
+            self.startup_rpc.attach(self)
         self.server.register_function(self.xmlrpc_clear, "clear_hud")
         self.server.register_function(self.xmlrpc_ping, "ping")
         self.server.register_function(self.xmlrpc_hide_hud, "hide_hud")
         self.server.register_function(self.xmlrpc_hide_rules, "hide_rules")
         self.server.register_function(self.xmlrpc_kill, "kill")
         self.server.register_function(self.xmlrpc_send, "send")
+        self.server.register_function(self.xmlrpc_send_many, "send_many")
         self.server.register_function(self.xmlrpc_show_hud, "show_hud")
         self.server.register_function(self.xmlrpc_show_rules, "show_rules")
+        self.server.register_function(self.xmlrpc_show_rules_delta, "show_rules_delta")
+        self.server.register_function(self.xmlrpc_stats, "stats")
+        self.server.register_function(self.xmlrpc_query_history, "query_history")
+        self.server.register_function(self.xmlrpc_profile_start, "profile_start")
+        self.server.register_function(self.xmlrpc_profile_stop, "profile_stop")
+        self.server.register_function(self.xmlrpc_memory_snapshot, "memory_snapshot")
+        if self.startup_rpc:
+            # already serving
+            return
         server_thread = threading.Thread(target=self.server.serve_forever)
         server_thread.daemon = True
         server_thread.start()
 
 
     def xmlrpc_clear(self):
-        PySide2.QtCore.QCoreApplication.postEvent(self, PySide2.QtCore.QEvent(CLEAR_HUD_EVENT))
+        # queued like sent texts, so it applies after the ones sent before it
+        self.send_queue.put([None])
         return 0
 
     def xmlrpc_ping(self):
@@ -416,13 +1153,102 @@ class HUDWindow(QMainWindow):
         QApplication.quit()
 
     def xmlrpc_send(self, text):
-        PySide2.QtCore.QCoreApplication.postEvent(self, RPCEvent(SEND_COMMAND_EVENT, text))
+        self.send_queue.put([text])
         return len(text)
 
+    def xmlrpc_send_many(self, texts):
+        self.send_queue.put(texts)
+        return len(texts)
+
     def xmlrpc_show_rules(self, text):
-        PySide2.QtCore.QCoreApplication.postEvent(self, RPCEvent(SHOW_RULES_EVENT, text))
+        ''' Shows the rules of a json payload, parsed here, off the GUI thread '''
+        import json
+        self.show_parsed_rules(SHOW_RULES_EVENT, json.loads(text))
         return len(text)
 
+    def xmlrpc_show_rules_delta(self, grammars):
+        ''' 
+        Shows the rules of a list of grammars, each either a grammar's json or 
+        rules_model.grammar_hash() of a json sent before. Sending only hashes, 
+        shows the rules unchanged. Grammars are parsed here, off the GUI thread.
+        Returns the hashes the HUD doesn't know (anymore), in which case nothing
+        is shown and those grammars should be sent as json again.
+        '''
+        with self.rules_cache_lock:
+            if self.rules_cache is None:
+                from rules_model import RulesCache
+                self.rules_cache = RulesCache()
+        rules, missing = self.rules_cache.resolve(grammars)
+        if not missing:
+            self.show_parsed_rules(SHOW_PARSED_RULES_EVENT, rules)
+        return missing
+
+    def show_parsed_rules(self, event_type, rules):
+        ''' 
+        Posts parsed rules to the rules window, and has their search index built
+        by the rules indexer thread, posted once it's done, so the call returns right away
+        '''
+        with self.rules_cache_lock:
+            if self.rules_indexer is None:
+                from rules_model import RulesIndexer
+                self.rules_indexer = RulesIndexer(self.rules_indexed)
+            PySide2.QtCore.QCoreApplication.postEvent(self, RPCEvent(event_type, rules))
+            # after the rules, so the window has them once the index arrives
+            self.rules_indexer.submit(rules)
+
+    def rules_indexed(self, rules, rules_index):
+        PySide2.QtCore.QCoreApplication.postEvent(
+                        self, RPCEvent(RULES_INDEXED_EVENT, (rules, rules_index)))
+
+    def xmlrpc_query_history(self, pattern="", since=0, limit=100):
+        ''' 
+        Returns the newest sent texts (up to limit), oldest first, matching 
+        the regular expression pattern, sent at or after since (seconds since the epoch). 
+        Answered from the history store, without touching the window.
+        '''
+        return [{"time": record.timestamp, "kind": record.kind, "text": record.text}
+                for record in self.history.query(pattern, since, limit)]
+
+    def xmlrpc_stats(self, reset=False):
+        ''' 
+        Returns timing histograms of the hot paths by name, 
+        empty unless COLLECT_STATS is True.
+        '''
+        return hud_stats.snapshot(reset)
+
+    def xmlrpc_profile_start(self):
+        '''
+        Starts profiling the GUI thread and the server thread
+        (the thread handling this call, unless RPC_SERVER_THREADED).
+        '''
+        PySide2.QtCore.QCoreApplication.postEvent(self, PySide2.QtCore.QEvent(PROFILE_START_EVENT))
+        if not RPC_SERVER_THREADED:
+            hud_profiler.start()
+        return 0
+
+    def xmlrpc_profile_stop(self):
+        '''
+        Stops profiling, returns the paths of the pstats files of the profiled threads:
+        the GUI thread (written once the window gets to it) and the server thread.
+        '''
+        paths = []
+        if hud_profiler.is_profiling(threading.main_thread().name):
+            gui_path = hud_profiler.dump_path(PROFILE_PATH, "gui")
+            PySide2.QtCore.QCoreApplication.postEvent(self, RPCEvent(PROFILE_STOP_EVENT, gui_path))
+            paths.append(gui_path)
+        server_path = hud_profiler.dump_path(PROFILE_PATH, "server")
+        if hud_profiler.stop(server_path):
+            paths.append(server_path)
+        return paths
+
+    def xmlrpc_memory_snapshot(self, limit=10):
+        '''
+        Dumps a tracemalloc snapshot, returns its path and its top lines by size.
+        Unless PROFILING was on from the start, the first call starts tracing.
+        '''
+        path, top = hud_profiler.memory_snapshot(PROFILE_PATH, limit)
+        return {"path": path, "top": top}
+
 
 def handler(signum, frame):
     """
@@ -435,14 +1261,43 @@ def handler(signum, frame):
     pass
 
 
-if __name__ == "__main__":
+def run_hud(server_address):
+    ''' Runs the HUD until it's killed, returns the exit code '''
     signal.signal(signal.SIGINT, handler)
-    server_address = (Communicator.LOCALHOST, Communicator().com_registry["hud"])
-    # allow_none=True means Python constant None will be translated into XML
-    server = SimpleXMLRPCServer(server_address, logRequests=False, allow_none=True)
+    # first, as it may change any setting used below
+    settings_file = None
+    if SETTINGS_PATH and os.path.exists(SETTINGS_PATH):
+        settings_file = SettingsFile(SETTINGS_PATH)
+        settings_file.load()
+    if PROFILING:
+        print("setting profiling: " + str(PROFILE_PATH))
+        hud_profiler.start_tracing()
+        # the GUI thread, from the start, until profile_stop or exit
+        hud_profiler.start()
+        if MEMORY_SNAPSHOT_INTERVAL:
+            hud_profiler.take_snapshots(PROFILE_PATH, MEMORY_SNAPSHOT_INTERVAL)
+    server = create_xmlrpc_server(server_address)
+    startup_rpc = None
+    if STARTUP_RPC:
+        # answers ping and keeps sent texts, while the window is built
+        startup_rpc = StartupRPC(server)
     app = QApplication(sys.argv)
-    window = HUDWindow(server)
+    window = HUDWindow(server, startup_rpc, screen=SCREEN, settings_file=settings_file)
     window.show()
+    if EXTRA_SCREENS:
+        print("setting extra screens: " + str(EXTRA_SCREENS))
+    for screen in EXTRA_SCREENS:
+        HUDWindow(None, screen=screen, leader=window).show()
     exit_code = app.exec_()
+    if PROFILING:
+        # unless profile_stop already dumped it
+        hud_profiler.stop(hud_profiler.dump_path(PROFILE_PATH, "gui"))
     server.shutdown()
-    sys.exit(exit_code)
+    if window.history_file:
+        window.history_file.close()
+    return exit_code
+
+
+if __name__ == "__main__":
+    server_address = (Communicator.LOCALHOST, Communicator().com_registry["hud"])
+    sys.exit(run_hud(server_address))
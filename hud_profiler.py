@@ -0,0 +1,90 @@
+'''
+Profiling of a running HUD, with cProfile and tracemalloc.
+
+A cProfile profile only covers the thread that enabled it, so every
+thread to profile starts and stops its own, the GUI thread through
+posted events. Profiles get dumped as pstats files and memory snapshots
+as tracemalloc dumps, named by their kind, thread and time.
+'''
+import cProfile
+import os
+import threading
+import time
+import tracemalloc
+
+# frames kept per traced allocation
+TRACEBACK_FRAMES = 10
+
+_lock = threading.Lock()
+# profiles by the name of the profiled thread
+_profiles = {}
+
+
+def dump_path(directory, kind):
+    ''' Returns a new path in directory, for a dump of kind ("gui", "memory"...) '''
+    os.makedirs(directory, exist_ok=True)
+    name = "{}-{}-{:03d}".format(kind, time.strftime("%Y%m%d-%H%M%S"),
+                                 int(time.time() * 1000) % 1000)
+    return os.path.join(directory, name + (".tracemalloc" if kind == "memory" else ".prof"))
+
+
+def start():
+    ''' Starts profiling the calling thread, returns False if it already is '''
+    name = threading.current_thread().name
+    with _lock:
+        if name in _profiles:
+            return False
+        profile = _profiles[name] = cProfile.Profile()
+    profile.enable()
+    return True
+
+
+def is_profiling(thread_name):
+    ''' Returns whether the thread named thread_name is being profiled '''
+    with _lock:
+        return thread_name in _profiles
+
+
+def stop(path):
+    ''' Stops profiling the calling thread and dumps its stats, returns False if it wasn't '''
+    with _lock:
+        profile = _profiles.pop(threading.current_thread().name, None)
+    if profile is None:
+        return False
+    profile.disable()
+    profile.dump_stats(path)
+    return True
+
+
+def start_tracing():
+    ''' Starts tracing memory allocations, unless it already is '''
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEBACK_FRAMES)
+
+
+def memory_snapshot(directory, limit=10):
+    '''
+    Dumps a tracemalloc snapshot, returns its path and the top lines by size.
+    Only allocations made since tracing started are seen, the first call
+    starts tracing (if it wasn't already), and returns no path.
+    '''
+    if not tracemalloc.is_tracing():
+        start_tracing()
+        return "", []
+    snapshot = tracemalloc.take_snapshot()
+    path = dump_path(directory, "memory")
+    snapshot.dump(path)
+    return path, [str(statistic) for statistic in snapshot.statistics("lineno")[:limit]]
+
+
+def take_snapshots(directory, interval):
+    ''' Dumps a memory snapshot every interval seconds, on a thread of its own '''
+    def take():
+        while True:
+            time.sleep(interval)
+            memory_snapshot(directory)
+
+    start_tracing()
+    snapshot_thread = threading.Thread(target=take)
+    snapshot_thread.daemon = True
+    snapshot_thread.start()
@@ -0,0 +1,143 @@
+'''
+Timing counters and histograms of the HUD hot paths.
+
+Nothing is measured until enable() gets called. Methods are timed by
+replacing them with timed wrappers (instrument), so while disabled
+the hot paths run the original methods, without any overhead.
+'''
+import threading
+import time
+
+from functools import wraps
+
+enabled = False
+
+_lock = threading.Lock()
+_histograms = {}
+_caches = {}
+
+
+class Histogram:
+    ''' Count, total and maximum of durations, with power of 2 microsecond buckets '''
+    __slots__ = ('count', 'total', 'maximum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        # bucket n counts durations under 2**n microseconds
+        self.buckets = {}
+
+    def record(self, microseconds):
+        self.count += 1
+        self.total += microseconds
+        if microseconds > self.maximum:
+            self.maximum = microseconds
+        bucket = int(microseconds).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        ''' Returns the upper bound of the bucket the percentile falls into '''
+        remaining = fraction * self.count
+        for bucket in sorted(self.buckets):
+            remaining -= self.buckets[bucket]
+            if remaining <= 0:
+                return min(2 ** bucket, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        ''' Returns the histogram as a dict, which xmlrpc can marshal '''
+        return {
+            "count": self.count,
+            "total_ms": self.total / 1000,
+            "mean_us": self.total / self.count,
+            "p50_us": self.percentile(0.5),
+            "p99_us": self.percentile(0.99),
+            "max_us": self.maximum,
+            # xmlrpc only allows string keys
+            "histogram_us": {str(2 ** bucket): count
+                             for bucket, count in sorted(self.buckets.items())},
+        }
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def record(name, seconds):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.record(seconds * 1e6)
+
+
+def register_cache(name, cache):
+    ''' Adds the hit rate of an LRUCache to the snapshot '''
+    _caches[name] = cache
+
+
+def snapshot(reset = False):
+    '''
+    Returns summaries of all histograms and the caches' hit rates by name,
+    optionally starting over
+    '''
+    with _lock:
+        summaries = {name: histogram.summary()
+                     for name, histogram in _histograms.items()}
+        if reset:
+            _histograms.clear()
+    for name, cache in _caches.items():
+        summaries[name] = cache.stats()
+        if reset:
+            cache.reset_stats()
+    return summaries
+
+
+def timed(function, name):
+    ''' Returns function wrapped, so its durations are recorded under name '''
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return wrapper
+
+
+def instrument(cls, *method_names):
+    ''' Replaces methods of cls with timed ones, recorded as Class.method '''
+    for method_name in method_names:
+        name = cls.__name__ + "." + method_name
+        setattr(cls, method_name, timed(getattr(cls, method_name), name))
+
+
+def instrument_event(cls, event_names):
+    '''
+    Replaces cls.event with one recording durations per event type,
+    named by event_names or by Qt's event type name.
+    Events with a posted_at time, also record the delay until they got handled.
+    '''
+    function = cls.event
+    prefix = cls.__name__ + ".event."
+
+    @wraps(function)
+    def event(self, event):
+        start = time.perf_counter()
+        posted_at = getattr(event, 'posted_at', None)
+        if posted_at is not None:
+            record("queue_delay", start - posted_at)
+        # the event might be deleted while handled, get its type before
+        event_type = event.type()
+        try:
+            return function(self, event)
+        finally:
+            elapsed = time.perf_counter() - start
+            name = event_names.get(event_type)
+            if name is None:
+                type_name = getattr(event_type, 'name', None)
+                name = type_name.decode() if type_name else str(int(event_type))
+            record(prefix + name, elapsed)
+    cls.event = event
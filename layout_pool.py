@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+
+from PySide2.QtGui import QFont
+
+from command_text_edit import create_text_layout, layout_key, layout_cache
+
+
+class LayoutPool:
+    '''
+    Worker threads laying out sent texts, before the GUI thread appends them,
+    so a burst of long texts doesn't keep it from painting.
+
+    Texts get laid out in the style (font, document margin, outline width)
+    and sized for the width of the log, last set by the GUI thread.
+    Layouts made in a style which got replaced meanwhile are discarded,
+    the GUI thread lays those texts out itself, as it would without the pool.
+    After a width change, layouts get sized again when they're used.
+    After each batch, laid_out gets called (from the worker thread).
+    '''
+
+    def __init__(self, workers, format_text, laid_out, gui_thread):
+        self.format_text = format_text
+        self.laid_out = laid_out
+        self.gui_thread = gui_thread
+        # (font, document margin, outline width), replaced on changes
+        self.style = None
+        self.width = 0
+        self.lock = threading.Lock()
+        # (style, [(layout_cache key, layout)]) per batch
+        self.batches = []
+        self.queue = queue.SimpleQueue()
+        for _ in range(workers):
+            worker_thread = threading.Thread(target=self.lay_out_queued)
+            worker_thread.daemon = True
+            worker_thread.start()
+
+    def set_style(self, font, document_margin, rect_outline_width, width):
+        ''' Sets the style of the log, called by the GUI thread '''
+        style = self.style
+        if (style is None or style[0].key() != font.key() or
+                style[1:] != (document_margin, rect_outline_width)):
+            self.style = (QFont(font), document_margin, rect_outline_width)
+        self.width = width
+
+    def submit(self, texts):
+        self.queue.put(texts)
+
+    def lay_out_queued(self):
+        while True:
+            texts = self.queue.get()
+            style = self.style
+            if style is not None:
+                font, document_margin, rect_outline_width = style
+                width = self.width
+                layouts = []
+                for text in texts:
+                    if text is None:
+                        continue
+                    html = self.format_text(text)
+                    key = layout_key(html, font, document_margin, rect_outline_width)
+                    if key in layout_cache:
+                        continue
+                    text_layout = create_text_layout(html, font, document_margin)
+                    text_layout.sizeForWidth(width)
+                    # owned by the GUI thread from here on
+                    text_layout.document.moveToThread(self.gui_thread)
+                    layouts.append((key, text_layout))
+                    # the GIL is kept during layout, the GUI thread gets a turn in between
+                    time.sleep(0)
+                with self.lock:
+                    self.batches.append((style, layouts))
+            self.laid_out()
+
+    def take(self):
+        ''' Moves the layouts made in the current style to layout_cache, called by the GUI thread '''
+        with self.lock:
+            batches = self.batches
+            self.batches = []
+        for style, layouts in batches:
+            if style is not self.style:
+                continue
+            for key, text_layout in layouts:
+                if key not in layout_cache:
+                    layout_cache.put(key, text_layout)
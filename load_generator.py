@@ -0,0 +1,283 @@
+'''
+Load generator, driving a HUD over rpc the way Caster does.
+
+Starts the HUD in a new process, with a stand-in Communicator in place of
+Caster's, and replays a mix of send, clear_hud and show_rules calls at a
+given rate, from a number of concurrent clients:
+
+    python load_generator.py --rate 200 --clients 4 --duration 10
+    python load_generator.py --mix send=8,clear_hud=1,show_rules=1
+    python load_generator.py --clients 4 --setting RPC_SERVER_THREADED=True
+
+Reports the round trip latency of each call, and for sent texts the latency
+until the window applied them (from the times query_history reports),
+along with the texts which were never applied (dropped) or applied later
+than --late milliseconds after being sent. Exits with 1 on dropped texts
+or failed calls.
+'''
+import argparse
+import ast
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import types
+import xmlrpc.client
+
+from unittest.mock import patch
+
+from benchmark_helpers import rules_json, free_port, wait_for_hud
+
+
+class Communicator:
+    ''' Stand-in for castervoice.lib.merge.communication.Communicator, reaching only the HUD '''
+    LOCALHOST = "127.0.0.1"
+    HUD_PORT = None
+
+    def __init__(self):
+        self.com_registry = {"hud": Communicator.HUD_PORT}
+
+    def get_com(self, name):
+        return xmlrpc.client.ServerProxy("http://{}:{}".format(
+                                    Communicator.LOCALHOST, self.com_registry[name]))
+
+
+def caster_stand_in():
+    ''' Returns a patch of sys.modules, replacing Caster and dragonfly with stand-ins '''
+    communication = types.ModuleType("castervoice.lib.merge.communication")
+    communication.Communicator = Communicator
+    settings = types.ModuleType("castervoice.lib.settings")
+    settings.HUD_TITLE = "HUD"
+    lib = types.ModuleType("castervoice.lib")
+    lib.settings = settings
+    dragonfly = types.ModuleType("dragonfly")
+    dragonfly.monitors = [types.SimpleNamespace(
+                            rectangle = types.SimpleNamespace(dx = 1920, dy = 1080))]
+    return patch.dict('sys.modules', {
+            'castervoice' : types.ModuleType("castervoice"),
+            'castervoice.lib' : lib,
+            'castervoice.lib.settings' : settings,
+            'castervoice.lib.merge' : types.ModuleType("castervoice.lib.merge"),
+            'castervoice.lib.merge.communication' : communication,
+            'dragonfly' : dragonfly,
+            })
+
+
+HUD_SCRIPT = '''
+import json
+import sys
+from load_generator import Communicator, caster_stand_in
+with caster_stand_in():
+    import hud
+    for name, value in json.loads(sys.argv[2]).items():
+        setattr(hud, name, value)
+    Communicator.HUD_PORT = int(sys.argv[1])
+    # as hud.py does when run by Caster
+    server_address = (Communicator.LOCALHOST, Communicator().com_registry["hud"])
+    sys.exit(hud.run_hud(server_address))
+'''
+
+# a command, the rule it matched, a status, like Caster sends them
+TEXTS = [
+    '$numb one',
+    'Numbers: [<long>] numb <wnKK>, , 1',
+    '$press down',
+    'Navigation: [<mim>] press <direction> [<nnavi50>], down',
+    '@sleep',
+    'Main: [<long>] sauce [<nnavi50>] wally [<nnavi50>] lease [<nnavi50>] '
+        'ross [<nnavi50>] and a long description to wrap around',
+]
+
+# sent texts end with their sequence number, to find them in the history
+SEQUENCE = re.compile(r" #(\d+)$")
+
+
+def start_hud(port, settings, show, timeout = 30):
+    ''' Starts the HUD in a new process, returns it once it answers ping '''
+    environment = dict(os.environ)
+    if not show:
+        environment["QT_QPA_PLATFORM"] = "offscreen"
+    process = subprocess.Popen(
+                [sys.executable, "-c", HUD_SCRIPT, str(port), json.dumps(settings)],
+                cwd = os.path.dirname(os.path.abspath(__file__)),
+                env = environment,
+                stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    Communicator.HUD_PORT = port
+    wait_for_hud(process, port, timeout)
+    return process
+
+
+class Client:
+    '''
+    Makes calls at a fixed rate, each picked from the mix, over a connection of its own.
+    Calls falling behind the schedule are made right away, not skipped.
+    '''
+    def __init__(self, index, mix, rate, duration, sequence):
+        self.random = random.Random(index)
+        self.operations, self.weights = zip(*mix.items())
+        self.interval = 1 / rate
+        self.duration = duration
+        self.sequence = sequence
+        # a few grammars
+        self.rules = rules_json(5, 5, 20)
+        # (operation, sequence number or None, wall time sent, round trip, error)
+        self.calls = []
+
+    def run(self):
+        hud = Communicator().get_com("hud")
+        start = time.perf_counter()
+        scheduled = start
+        while scheduled < start + self.duration:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            operation = self.random.choices(self.operations, self.weights)[0]
+            number = None
+            sent_at = time.time()
+            call_start = time.perf_counter()
+            try:
+                if operation == "send":
+                    number = next(self.sequence)
+                    hud.send("{} #{}".format(self.random.choice(TEXTS), number))
+                elif operation == "clear_hud":
+                    hud.clear_hud()
+                else:
+                    hud.show_rules(self.rules)
+                error = None
+            except (OSError, xmlrpc.client.Error) as e:
+                error = str(e)
+            self.calls.append((operation, number, sent_at,
+                               time.perf_counter() - call_start, error))
+            scheduled += self.interval
+
+
+def applied_times(since, count, settle):
+    '''
+    Returns the times the window applied sent texts, by sequence number,
+    waiting up to settle seconds for count of them
+    '''
+    hud = Communicator().get_com("hud")
+    deadline = time.perf_counter() + settle
+    while True:
+        records = hud.query_history(SEQUENCE.pattern, since, count)
+        if len(records) >= count or time.perf_counter() > deadline:
+            break
+        time.sleep(0.05)
+    times = {}
+    for record in records:
+        times[int(SEQUENCE.search(record["text"]).group(1))] = record["time"]
+    return times
+
+
+def percentiles(values):
+    ''' Returns the count, p50, p90, p99 and max of values, in milliseconds '''
+    values = sorted(values)
+    if not values:
+        return (0, 0, 0, 0, 0)
+    def at(fraction):
+        return values[min(int(fraction * len(values)), len(values) - 1)] * 1e3
+    return (len(values), at(0.5), at(0.9), at(0.99), values[-1] * 1e3)
+
+
+def report(calls, applied, late, elapsed):
+    ''' Prints the latencies, returns the numbers of dropped texts and failed calls '''
+    errors = [call for call in calls if call[4] is not None]
+    print("{} calls in {:.1f} s ({:.0f}/s), {} failed".format(
+                    len(calls), elapsed, len(calls) / elapsed, len(errors)))
+    print("{:<22} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+                    "latency (ms)", "count", "p50", "p90", "p99", "max"))
+    row = "{:<22} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}"
+    for operation in ("send", "clear_hud", "show_rules"):
+        round_trips = [call[3] for call in calls if call[0] == operation and call[4] is None]
+        if round_trips:
+            print(row.format("round trip " + operation, *percentiles(round_trips)))
+
+    sent = [call for call in calls if call[0] == "send" and call[4] is None]
+    delays = [applied[number] - sent_at for _, number, sent_at, _, _ in sent
+              if number in applied]
+    if delays:
+        print(row.format("gui apply send", *percentiles(delays)))
+    dropped = len(sent) - len(delays)
+    late_count = sum(1 for delay in delays if delay > late / 1e3)
+    print("dropped: {} of {} sent texts never applied".format(dropped, len(sent)))
+    print("late: {} applied more than {} ms after being sent".format(late_count, late))
+    for call in errors[:5]:
+        print("failed {}: {}".format(call[0], call[4]))
+    return dropped, len(errors)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        operation, _, weight = part.partition("=")
+        if operation not in ("send", "clear_hud", "show_rules"):
+            raise argparse.ArgumentTypeError("unknown call: " + operation)
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+def parse_setting(text):
+    name, _, value = text.partition("=")
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        raise argparse.ArgumentTypeError("not a python literal: " + value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Drives a HUD over rpc, the way Caster does")
+    parser.add_argument("--rate", type = float, default = 100,
+                        help = "calls per second, of all clients together")
+    parser.add_argument("--clients", type = int, default = 1,
+                        help = "concurrent clients, each with a connection of its own")
+    parser.add_argument("--duration", type = float, default = 5,
+                        help = "seconds to make calls for")
+    parser.add_argument("--mix", type = parse_mix, default = "send=18,clear_hud=1,show_rules=1",
+                        help = "weights of the calls made")
+    parser.add_argument("--late", type = float, default = 100,
+                        help = "milliseconds after which an applied text counts as late")
+    parser.add_argument("--settle", type = float, default = 5,
+                        help = "seconds to wait for the window to apply the last texts")
+    parser.add_argument("--setting", type = parse_setting, action = "append", default = [],
+                        metavar = "NAME=VALUE", help = "sets a HUD setting, like COLLECT_STATS=True")
+    parser.add_argument("--show", action = "store_true",
+                        help = "shows the window, instead of using the offscreen platform")
+    args = parser.parse_args()
+
+    settings = dict(args.setting)
+    # the history has to keep every sent text, to tell which were dropped
+    settings.setdefault("HISTORY_MAX_ENTRIES", max(10000, int(2 * args.rate * args.duration)))
+    # the user's settings file is ignored, unless set with --setting SETTINGS_PATH="..."
+    settings.setdefault("SETTINGS_PATH", None)
+    process = start_hud(free_port(), settings, args.show)
+    try:
+        sequence = itertools.count()
+        clients = [Client(index, args.mix, args.rate / args.clients, args.duration, sequence)
+                   for index in range(args.clients)]
+        threads = [threading.Thread(target = client.run) for client in clients]
+        since = time.time()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        calls = [call for client in clients for call in client.calls]
+        sent = sum(1 for call in calls if call[0] == "send" and call[4] is None)
+        applied = applied_times(since, sent, args.settle)
+        dropped, errors = report(calls, applied, args.late, elapsed)
+    finally:
+        process.kill()
+        process.communicate()
+    if dropped or errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
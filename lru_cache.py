@@ -0,0 +1,66 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''
+    Keeps the values of the most recently used keys, up to max_size.
+    With max_cost, also up to a total cost of values (like bytes of pixmaps).
+    Counts hits and misses, for the stats.
+    '''
+    def __init__(self, max_size, max_cost=None):
+        self.max_size = max_size
+        self.max_cost = max_cost
+        self.entries = OrderedDict()
+        # by key, of the values put with a cost
+        self.costs = {}
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        ''' Returns the value of key, or None if it isn't cached '''
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, cost=0):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.cost += cost - self.costs.pop(key, 0)
+        if cost:
+            self.costs[key] = cost
+        while len(self.entries) > self.max_size or (
+                self.max_cost is not None and self.cost > self.max_cost):
+            evicted_key, _ = self.entries.popitem(last=False)
+            self.cost -= self.costs.pop(evicted_key, 0)
+
+    def clear(self):
+        self.entries.clear()
+        self.costs.clear()
+        self.cost = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "cost": self.cost,
+            "max_cost": self.max_cost,
+        }
@@ -0,0 +1,419 @@
+import hashlib
+import json
+import re
+import threading
+
+from collections import defaultdict, OrderedDict
+from difflib import SequenceMatcher
+
+from PySide2.QtCore import Qt, QAbstractItemModel, QModelIndex
+
+
+class RulesNode:
+    '''
+    A grammar or a rule of the rules tree.
+    Its children (rules of a grammar, specs of a rule) are only created,
+    once the node gets expanded.
+    '''
+    __slots__ = ('parent', 'row', 'name', 'items', 'is_grammar', 'children')
+
+    def __init__(self, parent, row, name, items, is_grammar=False):
+        self.parent = parent
+        self.row = row
+        self.name = name
+        # rule dicts of a grammar, or "phrase::action" spec strings of a rule
+        self.items = items
+        self.is_grammar = is_grammar
+        self.children = None
+
+    def createChildren(self):
+        if self.is_grammar:
+            return [RulesNode(self, row, rule["name"], rule["specs"])
+                    for row, rule in enumerate(self.items)]
+        # specs stay strings, split into phrase and action when displayed
+        return list(self.items)
+
+
+class RulesModel(QAbstractItemModel):
+    '''
+    Tree of grammars, their rules and the rules' specs (phrase, action),
+    over the parsed rules, creating rows as they get expanded.
+    Grammars with a single rule show the rule at the top level.
+    Every index points to its parent node, spec rows have no node of their own.
+    '''
+    HEADERS = ('phrase', 'action')
+
+    def __init__(self, parent=None):
+        QAbstractItemModel.__init__(self, parent)
+        self.root = RulesNode(None, 0, "", [])
+        self.root.children = []
+        # grammars of the top level rows
+        self.grammars = []
+
+    def createTopLevelNode(self, row, grammar):
+        grammar_rules = grammar["rules"]
+        if len(grammar_rules) > 1:
+            return RulesNode(self.root, row, grammar["name"], grammar_rules, True)
+        rule = grammar_rules[0]
+        return RulesNode(self.root, row, rule["name"], rule["specs"])
+
+    def setRules(self, rules):
+        ''' Replaces the tree with the grammars of parsed rules '''
+        self.beginResetModel()
+        self.root = RulesNode(None, 0, "", rules)
+        self.grammars = [grammar for grammar in rules if grammar["rules"]]
+        self.root.children = [self.createTopLevelNode(row, grammar)
+                              for row, grammar in enumerate(self.grammars)]
+        self.endResetModel()
+
+    def updateRules(self, rules):
+        '''
+        Replaces the tree with the grammars of parsed rules, like setRules.
+        But only removes and inserts rows of grammars, which aren't the same
+        objects as before. Other rows keep their fetched children and expansion.
+        '''
+        grammars = [grammar for grammar in rules if grammar["rules"]]
+        nodes = self.root.children
+        matcher = SequenceMatcher(None, [id(grammar) for grammar in self.grammars],
+                                  [id(grammar) for grammar in grammars], autojunk=False)
+        # from the end, so earlier rows don't move before they're changed
+        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+            if tag in ('delete', 'replace'):
+                self.beginRemoveRows(QModelIndex(), i1, i2 - 1)
+                del nodes[i1:i2]
+                del self.grammars[i1:i2]
+                self.renumberTopLevel(i1)
+                self.endRemoveRows()
+            if tag in ('insert', 'replace'):
+                self.beginInsertRows(QModelIndex(), i1, i1 + j2 - j1 - 1)
+                nodes[i1:i1] = [self.createTopLevelNode(i1, grammar)
+                                for grammar in grammars[j1:j2]]
+                self.grammars[i1:i1] = grammars[j1:j2]
+                self.renumberTopLevel(i1)
+                self.endInsertRows()
+        self.root.items = rules
+
+    def renumberTopLevel(self, first_row):
+        nodes = self.root.children
+        for row in range(first_row, len(nodes)):
+            nodes[row].row = row
+
+    def nodeAt(self, index):
+        ''' Returns the node of the index, or the spec string for spec rows '''
+        if not index.isValid():
+            return self.root
+        return index.internalPointer().children[index.row()]
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column, self.nodeAt(parent))
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent_node = index.internalPointer()
+        if parent_node is self.root:
+            return QModelIndex()
+        return self.createIndex(parent_node.row, 0, parent_node.parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self.nodeAt(parent)
+        if type(node) is not RulesNode or node.children is None:
+            return 0
+        return len(node.children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(RulesModel.HEADERS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return False
+        node = self.nodeAt(parent)
+        return type(node) is RulesNode and bool(node.items)
+
+    def canFetchMore(self, parent):
+        node = self.nodeAt(parent)
+        return type(node) is RulesNode and node.children is None and bool(node.items)
+
+    def fetchMore(self, parent):
+        node = self.nodeAt(parent)
+        children = node.createChildren()
+        self.beginInsertRows(parent, 0, len(children) - 1)
+        node.children = children
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        node = self.nodeAt(index)
+        if type(node) is RulesNode:
+            return node.name if index.column() == 0 else None
+        phrase, _, action = node.partition('::')
+        return phrase if index.column() == 0 else action
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return RulesModel.HEADERS[section]
+        return None
+
+
+def entries_bits(entries, size):
+    ''' Returns an int with the bits of entries set '''
+    flags = bytearray(size // 8 + 1)
+    for entry in entries:
+        flags[entry >> 3] |= 1 << (entry & 7)
+    return int.from_bytes(flags, 'little')
+
+
+def bit_positions(bits):
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+class SpecMatches:
+    '''
+    Specs of a rule matching a search, decoded from candidate bits.
+    Candidates of queries longer than a trigram might not contain the query,
+    they are only verified once the rule gets expanded,
+    or until the first match, to know whether the rule is shown at all.
+    '''
+    __slots__ = ('specs', 'texts', 'first_entry', 'bits', 'query', 'matches')
+
+    def __init__(self, specs, texts, first_entry, bits, query):
+        self.specs = specs
+        self.texts = texts
+        self.first_entry = first_entry
+        self.bits = bits
+        # None, when every candidate is a match
+        self.query = query
+        self.matches = None
+
+    def verified(self):
+        texts = self.texts
+        first_entry = self.first_entry
+        query = self.query
+        for position in bit_positions(self.bits):
+            if query is None or query in texts[first_entry + position]:
+                yield position
+
+    def __bool__(self):
+        if self.matches is not None:
+            return bool(self.matches)
+        return any(True for _ in self.verified())
+
+    def __len__(self):
+        return len(self.list())
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def list(self):
+        if self.matches is None:
+            self.matches = [self.specs[position] for position in self.verified()]
+        return self.matches
+
+
+class RulesIndex:
+    '''
+    Search index over grammar names, rule names and specs of parsed rules,
+    built once per rules payload.
+
+    Texts are numbered in tree order (a grammar, then each of its rules
+    followed by the rule's specs), so the specs of a rule are a contiguous
+    range of bits in a set of matching entries.
+    Queries of at least 3 characters match anywhere, through an index of
+    trigrams. Shorter ones match the beginnings of words.
+    Postings common enough to be smaller as bits, are kept as an int.
+    '''
+    GRAM_LENGTH = 3
+    WORD_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.texts = texts = []
+        # per grammar: grammar entry, [(rule entry, end of its specs)]
+        self.entries = []
+        for grammar in rules:
+            grammar_entry = len(texts)
+            texts.append(grammar["name"].lower())
+            rule_entries = []
+            for rule in grammar["rules"]:
+                rule_entry = len(texts)
+                texts.append(rule["name"].lower())
+                texts.extend(spec.lower() for spec in rule["specs"])
+                rule_entries.append((rule_entry, len(texts)))
+            self.entries.append((grammar_entry, rule_entries))
+
+        n = RulesIndex.GRAM_LENGTH
+        grams = defaultdict(list)
+        prefixes = defaultdict(list)
+        for entry, text in enumerate(texts):
+            for gram in {text[i:i + n] for i in range(len(text) - n + 1)}:
+                grams[gram].append(entry)
+            words = RulesIndex.WORD_PATTERN.findall(text)
+            for prefix in {word[:1] for word in words} | {word[:2] for word in words}:
+                prefixes[prefix].append(entry)
+        self.grams = self.compact(grams)
+        self.prefixes = self.compact(prefixes)
+
+    def compact(self, postings):
+        ''' Replaces postings with bits, where those take less memory '''
+        size = len(self.texts)
+        for key, entries in postings.items():
+            if len(entries) * 64 > size:
+                postings[key] = entries_bits(entries, size)
+        return postings
+
+    def bits(self, postings):
+        if postings is None:
+            return 0
+        if type(postings) is int:
+            return postings
+        return entries_bits(postings, len(self.texts))
+
+    def candidates(self, query):
+        n = RulesIndex.GRAM_LENGTH
+        if len(query) < n:
+            return self.bits(self.prefixes.get(query))
+        bits = -1
+        for gram in {query[i:i + n] for i in range(len(query) - n + 1)}:
+            bits &= self.bits(self.grams.get(gram))
+            if not bits:
+                break
+        return bits
+
+    def search(self, query):
+        '''
+        Returns the rules, with only grammars, rules and specs matching the query.
+        A matching grammar or rule name keeps all of its rules or specs.
+        '''
+        query = query.lower()
+        bits = self.candidates(query)
+        if not bits:
+            return []
+        texts = self.texts
+        verify_query = query if len(query) > RulesIndex.GRAM_LENGTH else None
+
+        def matches(entry):
+            return (bits >> entry & 1 and
+                    (verify_query is None or verify_query in texts[entry]))
+
+        filtered = []
+        for grammar, (grammar_entry, rule_entries) in zip(self.rules, self.entries):
+            if not rule_entries:
+                continue
+            end = rule_entries[-1][1]
+            if not bits >> grammar_entry & ((1 << (end - grammar_entry)) - 1):
+                continue
+            if matches(grammar_entry):
+                filtered.append(grammar)
+                continue
+            rules = []
+            for rule, (rule_entry, specs_end) in zip(grammar["rules"], rule_entries):
+                if matches(rule_entry):
+                    rules.append(rule)
+                    continue
+                spec_bits = bits >> (rule_entry + 1) & ((1 << (specs_end - rule_entry - 1)) - 1)
+                if spec_bits:
+                    specs = SpecMatches(rule["specs"], texts, rule_entry + 1,
+                                        spec_bits, verify_query)
+                    if specs:
+                        rules.append({"name": rule["name"], "specs": specs})
+            if rules:
+                filtered.append({"name": grammar["name"], "rules": rules})
+        return filtered
+
+
+def grammar_hash(text):
+    ''' Returns the hash identifying a grammar's json, in show_rules_delta payloads '''
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class RulesCache:
+    '''
+    Parsed grammars of show_rules_delta payloads by the hash of their json,
+    so grammars which didn't change are neither sent nor parsed again.
+    Keeps the least recently used ones, up to max_grammars.
+    '''
+
+    def __init__(self, max_grammars=500):
+        self.max_grammars = max_grammars
+        self.grammars = OrderedDict()
+        # the server might handle calls on multiple threads
+        self.lock = threading.Lock()
+
+    def resolve(self, entries):
+        '''
+        Returns the parsed grammars of entries, each either a grammar's json,
+        or the grammar_hash of a json sent before, and the hashes missing
+        from the cache. The grammars are only complete, while none are missing.
+        '''
+        grammars = []
+        missing = []
+        with self.lock:
+            for entry in entries:
+                if entry.startswith('{'):
+                    key = grammar_hash(entry)
+                    grammar = self.grammars.get(key)
+                    if grammar is None:
+                        grammar = self.grammars[key] = json.loads(entry)
+                else:
+                    key = entry
+                    grammar = self.grammars.get(key)
+                    if grammar is None:
+                        missing.append(key)
+                        continue
+                self.grammars.move_to_end(key)
+                grammars.append(grammar)
+            while len(self.grammars) > self.max_grammars:
+                self.grammars.popitem(last=False)
+        return grammars, missing
+
+
+def same_grammars(rules, other):
+    ''' Returns whether both rules hold the same grammar objects, like unchanged cached ones '''
+    return len(rules) == len(other) and all(
+                grammar is other_grammar for grammar, other_grammar in zip(rules, other))
+
+
+class RulesIndexer:
+    '''
+    Builds the RulesIndex of shown rules on a thread of its own,
+    so neither the server nor the GUI thread waits for it.
+    Rules submitted while an index is being built replace each other,
+    only the newest get indexed. The last index gets reused,
+    while its grammars are the same objects, like cached ones of show_rules_delta.
+    indexed(rules, rules_index) gets called from the indexer thread.
+    '''
+
+    def __init__(self, indexed):
+        self.indexed = indexed
+        self.condition = threading.Condition()
+        self.pending = None
+        self.last = ([], None)
+        indexer_thread = threading.Thread(target=self.index_pending)
+        indexer_thread.daemon = True
+        indexer_thread.start()
+
+    def submit(self, rules):
+        with self.condition:
+            self.pending = rules
+            self.condition.notify()
+
+    def index_pending(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                rules = self.pending
+                self.pending = None
+            indexed_rules, rules_index = self.last
+            if rules_index is None or not same_grammars(rules, indexed_rules):
+                rules_index = RulesIndex(rules)
+                self.last = (rules, rules_index)
+            self.indexed(rules, rules_index)
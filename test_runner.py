@@ -5,27 +5,33 @@ from PySide2.QtGui import QColor, QPalette
 
 from unittest.mock import Mock, patch
         
-def hud_test():
+def caster_modules_mock():
+    ''' Returns a patch of sys.modules, replacing Caster and dragonfly with a mock '''
     attrs = {'settings.HUD_TITLE': "HUD"}
     mock = Mock(**attrs)
-    with patch.dict('sys.modules', {
+    return patch.dict('sys.modules', {
             'castervoice' : mock,
             'castervoice.lib' : mock,
             'castervoice.lib.merge' : mock,
             'castervoice.lib.merge.communication' : mock,
             'castervoice.lib.merge.communication.Communicator' : mock,
             'dragonfly' : mock,
-            }):
+            })
+        
+def hud_test():
+    with caster_modules_mock():
         from hud import HUDWindow
         huds_launch(HUDWindow)    
             
 def huds_launch(HUDWindow):
     app = QApplication(sys.argv)
+    leader = HUDWindow(Mock())
+    # the others show what gets sent to the first one
     windows = [
-            HUDWindow(Mock()),
-            HUDWindow(Mock()),
-            HUDWindow(Mock()),
-            HUDWindow(Mock()),
+            leader,
+            HUDWindow(None, leader=leader),
+            HUDWindow(None, leader=leader),
+            HUDWindow(None, leader=leader),
         ]
     
     setup_themes(windows)
@@ -34,23 +40,22 @@ def huds_launch(HUDWindow):
         window.show()
     
     messages = [
-        '<font color="blue">&lt;</font> numb one',
-        '<font color="red">&gt;</font> Numbers: [<long>] numb <wnKK>, , 1',
-        '<font color="blue">&lt;</font> numb two',
-        '<font color="red">&gt;</font> Numbers: [<long>] numb <wnKK>, , 2',
-        '<font color="blue">&lt;</font> numb three',
-        '<font color="red">&gt;</font> Numbers: [<long>] numb <wnKK>, , 3',
-        '<font color="blue">&lt;</font> numb four',
-        '<font color="red">&gt;</font> Numbers: [<long>] numb <wnKK>, , 4',
-        '<font color="blue">&lt;</font> numb five',
-        '<font color="red">&gt;</font> Numbers: [<long>] numb <wnKK>, , 5',
-        '<font color="blue">&lt;</font> numb six',
-        '<font color="red">&gt;</font> Numbers: [<long>] numb <wnKK>, , 6',
+        '$numb one',
+        'Numbers: [<long>] numb <wnKK>, , 1',
+        '$numb two',
+        'Numbers: [<long>] numb <wnKK>, , 2',
+        '$numb three',
+        'Numbers: [<long>] numb <wnKK>, , 3',
+        '$numb four',
+        'Numbers: [<long>] numb <wnKK>, , 4',
+        '$numb five',
+        'Numbers: [<long>] numb <wnKK>, , 5',
+        '$numb six',
+        'Numbers: [<long>] numb <wnKK>, , 6',
         ]
     
-    for i, message in enumerate(messages):
-        for window in windows:
-            window.output.append(message)
+    for message in messages:
+        leader.append_commands([message])
 
     app.exec_()
 
@@ -145,25 +150,26 @@ def theme_window(
     palette.setColor(QPalette.Text, text_color)
     window.setPalette(palette)
     
-    window.output.setTextEditBorderRadius(border_radius)
-    window.output.setTextEditMargins(margins)
-    window.output.setSpacing(spacing)
-    
-    window.output.setRectOutlineColor(outline_color)
-    window.output.setRectOutlineWidth(outline_width)
-    
-    if scrollbar:
-        window.output.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
-    else:
-        window.output.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-    window.output.setForceDisableBackground(force_disable_background)
-    
-    font = window.font()
-    font.setPointSize(font_size)
-    font.setFamily(font_family)
-    window.setFont(font)
+    with window.output.styleUpdate():
+        window.output.setTextEditBorderRadius(border_radius)
+        window.output.setTextEditMargins(margins)
+        window.output.setSpacing(spacing)
+        
+        window.output.setRectOutlineColor(outline_color)
+        window.output.setRectOutlineWidth(outline_width)
+        
+        if scrollbar:
+            window.output.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        else:
+            window.output.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        window.output.setForceDisableBackground(force_disable_background)
+        
+        font = window.font()
+        font.setPointSize(font_size)
+        font.setFamily(font_family)
+        window.setFont(font)
+        window.output.updateTextEdits()
     window.repaint()
-    window.output.updateTextEdits()
     window.setWindowFlag(Qt.FramelessWindowHint, frameless)
     
 if __name__ == '__main__':
@@ -0,0 +1,518 @@
+from bisect import bisect_right
+from itertools import accumulate
+
+from PySide2.QtCore import Qt, QRect, QModelIndex, QAbstractListModel
+from PySide2.QtGui import QPainter, QColor, QPalette, QRegion, QAbstractTextDocumentLayout
+from PySide2.QtWidgets import (QAbstractScrollArea, QStyledItemDelegate,
+                               QStyleOptionViewItem, QVBoxLayout)
+from PySide2 import QtWidgets
+
+from command_log import CommandLogMixin
+from command_text_edit import draw_cached_background, rect_region, cached_text_layout
+
+
+class CommandLogModel(QAbstractListModel):
+    '''
+    Holds the html of logged commands, oldest first.
+    Rows are only strings, widgets aren't created for them.
+    '''
+    def __init__(self, max_rows = 50000):
+        super().__init__()
+        self.max_rows = max_rows
+        self.rows = []
+
+    def rowCount(self, parent = QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def data(self, index, role = Qt.DisplayRole):
+        if index.isValid() and role == Qt.DisplayRole:
+            return self.rows[index.row()]
+        return None
+
+    def append(self, text):
+        self.appendMany([text])
+
+    def appendMany(self, texts):
+        ''' Appends rows in a single insertion, skipping ones over the limit '''
+        if len(texts) > self.max_rows:
+            texts = texts[len(texts) - self.max_rows:]
+        if not texts:
+            return
+
+        row = len(self.rows)
+        self.beginInsertRows(QModelIndex(), row, row + len(texts) - 1)
+        self.rows.extend(texts)
+        self.endInsertRows()
+        self.clearTo(self.max_rows)
+
+    def clearTo(self, num_to_keep):
+        ''' Removes the oldest rows, until num_to_keep are left '''
+        count = len(self.rows) - max(num_to_keep, 0)
+        if count > 0:
+            self.beginRemoveRows(QModelIndex(), 0, count - 1)
+            del self.rows[:count]
+            self.endRemoveRows()
+
+
+class CommandDelegate(QStyledItemDelegate):
+    '''
+    Lays out and paints a single row, the same way CommandTextEdit would.
+    Layouts are shared with CommandTextEdit, through layout_cache.
+    '''
+    def __init__(self,
+                parent = None,
+                text_edit_margins = 4,
+                rect_border_radius = 5,
+        ):
+        super().__init__(parent)
+
+        self.text_edit_margins = text_edit_margins
+        self.rect_border_radius = rect_border_radius
+        self.rect_outline_color = QColor(0, 0, 0, 0)
+        self.rect_outline_width = 0
+
+    def textLayout(self, option, text):
+        return cached_text_layout(text, option.font,
+                                  self.text_edit_margins + self.rect_outline_width,
+                                  self.rect_outline_width)
+
+    def sizeForWidth(self, option, text, width):
+        ''' Returns the preferred size of the row, for the given width '''
+        return self.textLayout(option, text).sizeForWidth(width)
+
+    def sizeHint(self, option, index):
+        return self.sizeForWidth(option, index.data(), option.rect.width())
+
+    def paint(self, painter, option, index):
+        rect = option.rect
+        painter.save()
+
+        if option.palette.color(QPalette.Base).alpha() > 0:
+            # the log clips its painter to the exposed rect
+            exposed_rect = (painter.clipBoundingRect().toAlignedRect()
+                            if painter.hasClipping() else rect)
+            draw_cached_background(
+                            painter,
+                            self.parent().devicePixelRatioF(),
+                            rect,
+                            exposed_rect,
+                            option.palette.brush(QPalette.Base),
+                            self.rect_border_radius,
+                            self.rect_outline_color,
+                            self.rect_outline_width
+                )
+
+        doc = self.textLayout(option, index.data()).documentForWidth(rect.width())
+
+        painter.translate(rect.topLeft())
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette = option.palette
+        doc.documentLayout().draw(painter, context)
+
+        painter.restore()
+
+
+class VirtualCommandLog(CommandLogMixin, QAbstractScrollArea):
+    '''
+    Command log keeping its history in a CommandLogModel.
+    Only the rows inside the viewport get measured and painted,
+    so the history can be much longer than with CommandLog.
+
+    Row heights are kept in a list, with the top of each row in another.
+    Rows that weren't measured since the last width/style change
+    keep their old size, until they get scrolled into view.
+    '''
+    def __init__(self,
+                max_text_edits = 50000,
+                text_edit_margins = 4,
+                rect_border_radius = 5,
+        ):
+        super().__init__()
+
+        self.max_text_edits = max_text_edits
+
+        self.rect_border_radius = rect_border_radius
+        self.text_edit_margins = text_edit_margins
+
+        self.model = CommandLogModel(max_text_edits)
+        self.delegate = CommandDelegate(self, text_edit_margins, rect_border_radius)
+
+        self.direction = QVBoxLayout.TopToBottom
+        self.alignment = Qt.AlignLeft | Qt.AlignTop
+        self.spacing = 5
+
+        # per row, in model order
+        self.widths = []
+        self.heights = []
+        self.tops = []
+        self.measured = bytearray()
+        # tops are absolute, top of the first row is top_base
+        self.top_base = 0
+
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.viewport().setAutoFillBackground(False)
+
+        self.rect_outline_color = QColor(0, 0, 0, 0)
+        self.rect_outline_width = 0
+        self.scroll_point_pos = None
+        self.force_disable_background = False
+        self.backgroundless_mask = None
+        # see styleUpdate()
+        self.style_update_depth = 0
+        self.style_update_position = None
+        self.relayout_pending = False
+        # regions of rounded rectangles, by their width, height and radius
+        self.region_cache = {}
+
+        self.model.rowsInserted.connect(self.rowsInserted)
+        self.model.rowsRemoved.connect(self.rowsRemoved)
+
+    def setTextEditMargins(self, margins):
+        ''' Retroactively sets margins of rows, updating scrollbar position '''
+        if self.text_edit_margins != margins:
+            self.text_edit_margins = margins
+            self.delegate.text_edit_margins = margins
+            self.relayout()
+
+    def setTextEditBorderRadius(self, radius):
+        ''' Retroactively sets border radius of rows '''
+        if self.rect_border_radius != radius:
+            self.rect_border_radius = radius
+            self.delegate.rect_border_radius = radius
+            self.updateViewport()
+
+    def setDrawFrame(self, draw_frame):
+        if draw_frame == True:
+            self.setFrameShape(QtWidgets.QFrame.StyledPanel)
+        else:
+            self.setFrameShape(QtWidgets.QFrame.NoFrame)
+
+    def setDirection(self, direction):
+        ''' Sets layout direction, updating scrollbar position '''
+        if self.direction != direction:
+            self.direction = direction
+
+            if self.heights:
+                # inverting scroll bar position
+                # to match previously shown rows
+                scroll_bar = self.verticalScrollBar()
+                scroll_bar.setValue(scroll_bar.maximum() - scroll_bar.value())
+            self.updateViewport()
+
+    def setAlignment(self, alignment):
+        ''' Retroactively sets alignment of rows in the viewport '''
+        if self.alignment != alignment:
+            self.alignment = alignment
+            self.updateViewport()
+
+    def setSpacing(self, spacing):
+        ''' Retroactively sets spacing between rows '''
+        if self.spacing != spacing:
+            self.spacing = spacing
+            self.relayout()
+
+    def setMaxTextEdits(self, max):
+        self.max_text_edits = max
+        self.model.max_rows = max
+        self.clearTo(max)
+
+    def getNormalizedScrollBarPosition(self):
+        ''' Returns scroll bar position normalized to values between 0 and 1 '''
+        scroll_bar = self.verticalScrollBar()
+        if scroll_bar.maximum() == 0:
+            if self.direction == QVBoxLayout.TopToBottom:
+                return 1
+            else:
+                return 0
+        return scroll_bar.value() / scroll_bar.maximum()
+
+    def setScrollBarToNormalizedPosition(self, position):
+        maximum = self.verticalScrollBar().maximum()
+        self.verticalScrollBar().setValue(round(maximum * position))
+
+    def setRectOutlineColor(self, color):
+        ''' Retroactively sets rectangle outline color '''
+        if self.rect_outline_color != color:
+            self.rect_outline_color = color
+            self.delegate.rect_outline_color = color
+            self.updateViewport()
+
+    def setRectOutlineWidth(self, width):
+        ''' Retroactively sets rectangle outline width '''
+        if self.rect_outline_width != width:
+            self.rect_outline_width = width
+            self.delegate.rect_outline_width = width
+            self.relayout()
+
+    def append(self, text):
+        ''' Appends a new row to the end '''
+        self.model.append(text)
+
+    def appendMany(self, texts):
+        ''' Appends new rows to the end, measuring and scrolling once '''
+        self.model.appendMany(texts)
+
+    def clearTo(self, num_to_keep):
+        self.model.clearTo(num_to_keep)
+
+    def clear(self):
+        self.clearTo(0)
+
+    def viewOptions(self):
+        option = QStyleOptionViewItem()
+        option.initFrom(self)
+        option.font = self.font()
+        option.palette = self.palette()
+        return option
+
+    def layoutStyle(self):
+        ''' Returns what layouts of new rows depend on: font, margin, outline and width '''
+        return (self.font(), self.text_edit_margins + self.rect_outline_width,
+                self.rect_outline_width, self.viewport().width())
+
+    def measure(self, row, option = None):
+        ''' Updates the size of a row, returns True if its height changed '''
+        if option is None:
+            option = self.viewOptions()
+        size = self.delegate.sizeForWidth(
+                        option, self.model.rows[row], self.viewport().width())
+        self.widths[row] = size.width()
+        self.measured[row] = 1
+        if self.heights[row] != size.height():
+            self.heights[row] = size.height()
+            return True
+        return False
+
+    def updateTops(self, first_row):
+        ''' Recalculates tops of rows starting from first_row '''
+        tops = self.tops
+        heights = self.heights
+        del tops[first_row:]
+        if first_row >= len(heights):
+            return
+
+        if first_row == 0:
+            top = self.top_base
+        else:
+            top = tops[-1] + heights[first_row - 1] + self.spacing
+
+        spacing = self.spacing
+        tops.extend(accumulate(
+                (height + spacing for height in heights[first_row:-1]),
+                initial = top))
+
+    def contentHeight(self):
+        if not self.heights:
+            return 0
+        return self.tops[-1] + self.heights[-1] - self.top_base
+
+    def contentOffset(self):
+        ''' Returns the offset of the content, when it's smaller than the viewport '''
+        free_space = self.viewport().height() - self.contentHeight()
+        if free_space <= 0:
+            return 0
+        if self.alignment & Qt.AlignBottom:
+            return free_space
+        if self.alignment & Qt.AlignVCenter:
+            return free_space // 2
+        return 0
+
+    def rowRect(self, row, content_height, offset):
+        ''' Returns the rectangle of a row in viewport coordinates '''
+        width = self.widths[row]
+        height = self.heights[row]
+        top = self.tops[row] - self.top_base
+        if self.direction != QVBoxLayout.TopToBottom:
+            top = content_height - top - height
+
+        viewport_width = self.viewport().width()
+        if self.alignment & Qt.AlignRight:
+            x = viewport_width - width
+        elif self.alignment & Qt.AlignHCenter:
+            x = (viewport_width - width) // 2
+        else:
+            x = 0
+
+        y = top + offset - self.verticalScrollBar().value()
+        return QRect(x, y, width, height)
+
+    def visibleRows(self, area):
+        ''' Returns the range of rows, intersecting the area of the viewport '''
+        if not self.heights:
+            return range(0)
+
+        content_height = self.contentHeight()
+        start = area.top() + self.verticalScrollBar().value() - self.contentOffset()
+        end = start + area.height()
+        if self.direction != QVBoxLayout.TopToBottom:
+            start, end = content_height - end, content_height - start
+
+        first = max(bisect_right(self.tops, self.top_base + start) - 1, 0)
+        last = bisect_right(self.tops, self.top_base + end, first)
+        return range(first, last)
+
+    def measureVisibleRows(self):
+        '''
+        Measures rows inside the viewport, that weren't measured yet.
+        Measuring can move other rows into the viewport, so it's repeated.
+        '''
+        option = None
+        for _ in range(10):
+            first_changed = None
+            for row in self.visibleRows(self.viewport().rect()):
+                if not self.measured[row]:
+                    if option is None:
+                        option = self.viewOptions()
+                    if self.measure(row, option) and first_changed is None:
+                        first_changed = row
+            if first_changed is None:
+                break
+
+            at_bottom = self.isAtBottom()
+            self.invalidateBackgroundlessMask()
+            self.updateTops(first_changed)
+            self.updateScrollBar()
+            if at_bottom:
+                self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
+
+    def isAtBottom(self):
+        scroll_bar = self.verticalScrollBar()
+        return scroll_bar.value() == scroll_bar.maximum()
+
+    def endStyleUpdate(self, relayout_pending, normalized_position):
+        ''' Relays out rows once, after the setters of styleUpdate() '''
+        if relayout_pending:
+            self.relayout(normalized_position)
+
+    def relayout(self, normalized_position = None):
+        ''' Marks all rows as not measured, keeping the scrollbar position '''
+        if self.style_update_depth:
+            self.relayout_pending = True
+            return
+        if normalized_position is None:
+            normalized_position = self.getNormalizedScrollBarPosition()
+
+        self.measured = bytearray(len(self.heights))
+        self.updateTops(0)
+        self.updateScrollBar()
+        self.setScrollBarToNormalizedPosition(normalized_position)
+        self.measureVisibleRows()
+
+        self.setScrollBarToNormalizedPosition(normalized_position)
+        self.updateViewport()
+
+    def updateScrollBar(self):
+        scroll_bar = self.verticalScrollBar()
+        viewport_height = self.viewport().height()
+
+        scroll_bar.setPageStep(viewport_height)
+        scroll_bar.setSingleStep(self.fontMetrics().height())
+        scroll_bar.setRange(0, max(self.contentHeight() - viewport_height, 0))
+
+    def rowsInserted(self, parent, first, last):
+        count = last - first + 1
+        self.widths[first:first] = [0] * count
+        self.heights[first:first] = [0] * count
+        self.measured[first:first] = bytes(count)
+
+        option = self.viewOptions()
+        for row in range(first, last + 1):
+            self.measure(row, option)
+        self.updateTops(first)
+        self.updateScrollBar()
+
+        if self.direction == QVBoxLayout.TopToBottom:
+            self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
+        self.updateViewport()
+
+    def rowsRemoved(self, parent, first, last):
+        scroll_bar = self.verticalScrollBar()
+        position = scroll_bar.value()
+        removed_height = 0
+        if first == 0 and last + 1 < len(self.tops):
+            # only the oldest rows, the others keep their tops
+            removed_height = self.tops[last + 1] - self.top_base
+            self.top_base = self.tops[last + 1]
+            del self.tops[:last + 1]
+        else:
+            del self.tops[first:]
+
+        del self.widths[first:last + 1]
+        del self.heights[first:last + 1]
+        del self.measured[first:last + 1]
+        if not self.heights:
+            self.top_base = 0
+        self.updateTops(len(self.tops))
+
+        self.updateScrollBar()
+        if self.direction == QVBoxLayout.TopToBottom:
+            scroll_bar.setValue(position - removed_height)
+        self.updateViewport()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.invalidateBackgroundlessMask()
+        if event.oldSize().width() != event.size().width():
+            self.updateTextEdits()
+        else:
+            self.updateScrollBar()
+
+    def updateTextEdits(self):
+        ''' Remeasures rows after a width, font or palette change '''
+        self.relayout()
+
+    def scrollContentsBy(self, dx, dy):
+        self.updateViewport()
+
+    def updateViewport(self):
+        ''' Repaints the viewport, after rows got added, moved or changed '''
+        self.invalidateBackgroundlessMask()
+        self.viewport().update()
+
+    def paintEvent(self, event):
+        self.measureVisibleRows()
+
+        painter = QPainter(self.viewport())
+        painter.setClipRect(event.rect())
+        option = self.viewOptions()
+        content_height = self.contentHeight()
+        offset = self.contentOffset()
+        for row in self.visibleRows(event.rect()):
+            option.rect = self.rowRect(row, content_height, offset)
+            self.delegate.paint(painter, option, self.model.index(row))
+
+        if self.scroll_point_pos:
+            self.paintScrollingPoint(painter)
+
+    def mouseTrackingWidget(self):
+        return self.viewport()
+
+    def viewportContentsRegion(self):
+        ''' Returns the region, in viewport coordinates, that rows are drawn in '''
+        return QRegion(self.viewport().rect())
+
+    def rowRegion(self, rect):
+        ''' Returns the region of a row's rectangle, cached by its size '''
+        key = (rect.width(), rect.height(), self.rect_border_radius)
+        region = self.region_cache.get(key)
+        if region is None:
+            if len(self.region_cache) > 1000:
+                self.region_cache.clear()
+            region = QRegion(rect_region(QRect(0, 0, rect.width(), rect.height()),
+                                         self.rect_border_radius))
+            self.region_cache[key] = region
+        return region.translated(rect.topLeft())
+
+    def commandsRegion(self):
+        ''' Returns the region of the rows inside the viewport '''
+        viewport_offset = self.viewport().pos()
+        content_height = self.contentHeight()
+        offset = self.contentOffset()
+        rows_region = QRegion()
+        for row in self.visibleRows(self.viewport().rect()):
+            rect = self.rowRect(row, content_height, offset)
+            rect.translate(viewport_offset)
+            rows_region += self.rowRegion(rect)
+        return rows_region